@@ -4,45 +4,737 @@ Scrape the list of ongoing anime, maybe subscribe to them.
 
 import os
 import re
+import json
+import time
+import sqlite3
+import threading
+import signal
+import shutil
+import tempfile
+import socket
 import requests
 import argparse
-import yaml
-import feedparser
+import sys
+import marshal
+import hashlib
+import random
+import importlib.util
+import contextlib
+import collections
 from rich import print
-from rich.console import Console
 from pprint import pprint
-from bs4 import BeautifulSoup
-from PyInquirer import prompt
-from prompt_toolkit.validation import Validator, ValidationError
-from anime_downloader.sites.animerush import AnimeRush, AnimeRushEpisode
-from anime_downloader.util import setup_logger, external_download
-from anime_downloader.sites import exceptions as a_exceptions
+from requests.adapters import HTTPAdapter
 from urllib import error as u_errors
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+# yaml, xml.etree, bs4, PyInquirer, prompt_toolkit, rich.console and
+# anime_downloader are imported where they are used, a headless run that
+# finds nothing new never needs most of them.
 
-class NumberValidator(Validator):
-    def validate(self, document):
+if importlib.util.find_spec('lxml') is not None:
+    html_parser = 'lxml'
+else:
+    html_parser = 'html.parser'
+
+
+# files we write get the permissions open() would have given them
+_umask = os.umask(0o022)
+os.umask(_umask)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', sync=False):
+    """Write to a fresh temp file next to path, renamed over it when done"""
+    sdir = os.path.dirname(path) or '.'
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=sdir)
+    try:
+        with os.fdopen(fd, mode) as stream:
+            yield stream
+            if sync:
+                stream.flush()
+                os.fsync(stream.fileno())
+        try:
+            perms = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            perms = 0o666 & ~_umask
+        os.chmod(tmp_file, perms)
+        os.replace(tmp_file, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+
+def number_validator():
+    """Build the prompt_toolkit validator for numeric answers"""
+    from prompt_toolkit.validation import Validator, ValidationError
+
+    class NumberValidator(Validator):
+        def validate(self, document):
+            try:
+                int(document.text)
+            except ValueError:
+                raise ValidationError(
+                    message='Please enter a number',
+                    cursor_position=len(document.text))  # Move cursor to end
+
+    return NumberValidator
+
+
+class RunReport:
+    """Per-phase timings, counters and download throughput for one run"""
+
+    def __init__(self, mode='rss'):
+        self.lock = threading.Lock()
+        self.reset(mode)
+
+    def reset(self, mode):
+        """Start a new run"""
+        with self.lock:
+            self.mode = mode
+            self.started = time.time()
+            self.phases = dict()
+            self.counters = dict()
+            self.downloads = 0
+            self.bytes = 0
+            self.download_seconds = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block under a phase name"""
+        start = time.perf_counter()
         try:
-            int(document.text)
-        except ValueError:
-            raise ValidationError(
-                message='Please enter a number',
-                cursor_position=len(document.text))  # Move cursor to end
+            yield
+        finally:
+            took = time.perf_counter() - start
+            with self.lock:
+                calls, total, longest = self.phases.get(name, (0, 0.0, 0.0))
+                self.phases[name] = (calls + 1, total + took, max(longest, took))
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def download(self, nbytes, seconds):
+        """Record one finished transfer"""
+        with self.lock:
+            self.downloads += 1
+            self.bytes += nbytes
+            self.download_seconds += seconds
+
+    def to_dict(self):
+        with self.lock:
+            phases = dict()
+            for (name, (calls, total, longest)) in self.phases.items():
+                phases[name] = {'calls': calls, 'seconds': round(total, 6),
+                                'max_seconds': round(longest, 6)}
+            throughput = 0
+            if self.download_seconds:
+                throughput = self.bytes / self.download_seconds
+            return {
+                'mode': self.mode,
+                'started': self.started,
+                'seconds': round(time.time() - self.started, 6),
+                'phases': phases,
+                'counters': dict(self.counters),
+                'downloads': {'count': self.downloads, 'bytes': self.bytes,
+                              'seconds': round(self.download_seconds, 6),
+                              'bytes_per_second': round(throughput, 1)},
+            }
 
+    def write_json(self, path):
+        with atomic_write(path) as stream:
+            json.dump(self.to_dict(), stream, indent=2)
+
+    def write_prometheus(self, path):
+        """Write a node exporter textfile collector file"""
+        data = self.to_dict()
+        mode = data['mode']
+        lines = [
+            '# HELP animerush_run_seconds Wall time of the last run.',
+            '# TYPE animerush_run_seconds gauge',
+            'animerush_run_seconds{{mode="{}"}} {}'.format(mode, data['seconds']),
+            '# HELP animerush_run_timestamp_seconds When the last run started.',
+            '# TYPE animerush_run_timestamp_seconds gauge',
+            'animerush_run_timestamp_seconds{{mode="{}"}} {}'.format(mode, data['started']),
+            '# HELP animerush_phase_seconds Time spent in each phase of the last run.',
+            '# TYPE animerush_phase_seconds gauge',
+        ]
+        for (name, phase) in sorted(data['phases'].items()):
+            lines.append('animerush_phase_seconds{{mode="{}",phase="{}"}} {}'.format(
+                mode, name, phase['seconds']))
+        lines.append('# HELP animerush_phase_calls Calls of each phase in the last run.')
+        lines.append('# TYPE animerush_phase_calls gauge')
+        for (name, phase) in sorted(data['phases'].items()):
+            lines.append('animerush_phase_calls{{mode="{}",phase="{}"}} {}'.format(
+                mode, name, phase['calls']))
+        lines.append('# HELP animerush_events Counters from the last run.')
+        lines.append('# TYPE animerush_events gauge')
+        for (name, value) in sorted(data['counters'].items()):
+            lines.append('animerush_events{{mode="{}",event="{}"}} {}'.format(mode, name, value))
+        downloads = data['downloads']
+        lines += [
+            '# HELP animerush_download_bytes Bytes downloaded in the last run.',
+            '# TYPE animerush_download_bytes gauge',
+            'animerush_download_bytes{{mode="{}"}} {}'.format(mode, downloads['bytes']),
+            '# HELP animerush_downloads Episodes downloaded in the last run.',
+            '# TYPE animerush_downloads gauge',
+            'animerush_downloads{{mode="{}"}} {}'.format(mode, downloads['count']),
+            '# HELP animerush_download_bytes_per_second Average transfer rate in the last run.',
+            '# TYPE animerush_download_bytes_per_second gauge',
+            'animerush_download_bytes_per_second{{mode="{}"}} {}'.format(
+                mode, downloads['bytes_per_second']),
+        ]
+        with atomic_write(path) as stream:
+            stream.write('\n'.join(lines) + '\n')
+
+
+report = RunReport()
+
+
+def write_report(config):
+    """Save the run report as JSON, and for Prometheus if configured"""
+    report.write_json(config.get('report_file', state_path(config, 'last_run.json')))
+    if config.get('prometheus_textfile'):
+        report.write_prometheus(config['prometheus_textfile'])
+
+
+class MonitoredRegistry:
+    """Index of config['monitored'] by full name and normalized title"""
+    key_strip = re.compile('[^a-z0-9]+')
+
+    def __init__(self, mlist):
+        self.mlist = mlist
+        self.by_name = dict()
+        self.by_key = dict()
+        for anime in mlist:
+            self._index(anime)
+
+    def _index(self, anime):
+        # first entry wins, same as the old linear scan
+        self.by_name.setdefault(anime['full_name'], anime)
+        key = self.title_key(anime['full_name'])
+        # titles with no ascii alphanumerics would all share ''
+        if key:
+            self.by_key.setdefault(key, anime)
+
+    @classmethod
+    def title_key(cls, name):
+        """Reduce a title to lowercase ascii alphanumerics"""
+        fix_str = name.encode("ascii", 'ignore').decode().lower()
+        return cls.key_strip.sub('', fix_str)
+
+    def add(self, anime):
+        """Append a new entry to the monitored list and index it"""
+        self.mlist.append(anime)
+        self._index(anime)
+
+    def find(self, anime_name):
+        """Return the dict of the monitored anime if any."""
+        anime = self.by_name.get(anime_name)
+        key = self.title_key(anime_name)
+        if anime is None and key:
+            anime = self.by_key.get(key)
+        return anime
+
+    def is_monitored(self, anime_name):
+        """ Do we monitor this anime?"""
+        anime = self.find(anime_name)
+        if anime is None:
+            return False
+        return anime['monitored']
+
+    def monitored(self):
+        """Iterate over the anime we actually monitor"""
+        for anime in self.mlist:
+            if anime['monitored']:
+                yield anime
+
+    def __contains__(self, anime_name):
+        return self.find(anime_name) is not None
+
+    def __len__(self):
+        return len(self.mlist)
+
+
+class EpisodeIndex:
+    """Episode files on disk, one scandir per directory, cached by mtime"""
+    s_form = re.compile(r'^(?P<prefix>.*) - S(?P<season>[0-9]+)E(?P<ep>[0-9]+(\.[0-9]+)?)\.mp4$')
+    u_form = re.compile(r'^(?P<prefix>.*)_(?P<ep>[0-9]+(\.[0-9]+)?)\.mp4$')
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.dirs = dict()
+        self.checked = set()
+        self.dirty = False
+        # the pipeline checks episodes on its pool while downloads are added
+        self.lock = threading.RLock()
+        if cache_file is None or not os.path.exists(cache_file):
+            return
+        try:
+            with open(cache_file, 'r') as stream:
+                cached = json.load(stream)
+        except (OSError, ValueError):
+            return
+        for path, (mtime, keys) in cached.items():
+            self.dirs[path] = [mtime, set(keys)]
+
+    @staticmethod
+    def ep_key(ep_num):
+        """Episode number without zero fill, specials keep their fraction"""
+        whole, dot, frac = str(ep_num).partition('.')
+        return (whole.lstrip('0') or '0') + dot + frac
+
+    def parse_name(self, filename):
+        """Reduce an episode filename to its lookup key"""
+        m = self.s_form.match(filename)
+        if m is not None:
+            return '{} - S{}E{}'.format(m.group('prefix'),
+                                        m.group('season').lstrip('0').zfill(2),
+                                        self.ep_key(m.group('ep')))
+        m = self.u_form.match(filename)
+        if m is not None:
+            return m.group('prefix') + '_' + self.ep_key(m.group('ep'))
+        return None
 
-class AnimeRushRSS:
-    url = 'http://www.animerush.tv/rss.xml'
-    rss = None
+    def _scan(self, path):
+        keys = set()
+        with os.scandir(path) as it:
+            for entry in it:
+                key = self.parse_name(entry.name)
+                if key is not None:
+                    keys.add(key)
+        return keys
+
+    def entries(self, path):
+        """Return the episode keys found in a directory"""
+        with self.lock:
+            if path in self.checked:
+                return self.dirs.get(path, [None, set()])[1]
+            self.checked.add(path)
+
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                if self.dirs.pop(path, None) is not None:
+                    self.dirty = True
+                return set()
+
+            cached = self.dirs.get(path)
+            if cached is None or cached[0] != mtime:
+                self.dirs[path] = [mtime, self._scan(path)]
+                self.dirty = True
+            return self.dirs[path][1]
+
+    def add(self, path, filename):
+        """Record a file we just wrote, without rescanning the directory"""
+        with self.lock:
+            key = self.parse_name(filename)
+            keys = self.entries(path)
+            if key is not None:
+                keys.add(key)
+            self.dirs[path] = [os.stat(path).st_mtime_ns, keys]
+            self.dirty = True
+
+    def save(self):
+        """Write the index back to the cache file if anything changed"""
+        if self.cache_file is None or not self.dirty:
+            return
+        cached = dict()
+        with self.lock:
+            for path, (mtime, keys) in self.dirs.items():
+                cached[path] = [mtime, sorted(keys)]
+        with atomic_write(self.cache_file) as stream:
+            json.dump(cached, stream)
+        self.dirty = False
+
+
+class StateStore:
+    """SQLite record of what happened to each RSS entry"""
+    done = ('downloaded', 'present')
+    retry = ('not_found', 'http_error', 'partial')
+    # tried again without using up an attempt
+    deferred = ('no_space', 'host_down')
+
+    def __init__(self, db_file, retry_limit=10):
+        self.retry_limit = retry_limit
+        # several workers, maybe on several hosts, can share one state file
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.db = sqlite3.connect(db_file, timeout=30)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                guid TEXT PRIMARY KEY,
+                show TEXT,
+                ep_num TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                first_seen REAL,
+                updated REAL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS feed_polls (
+                polled REAL,
+                changed INTEGER
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS show_quality (
+                url TEXT PRIMARY KEY,
+                quality TEXT,
+                probed REAL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS quality_probes (
+                stamp REAL,
+                url TEXT,
+                quality TEXT,
+                probes INTEGER,
+                seconds REAL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                owner TEXT,
+                expires REAL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS shard_progress (
+                shard TEXT PRIMARY KEY,
+                owner TEXT,
+                shows INTEGER,
+                shows_done INTEGER,
+                episodes INTEGER,
+                episodes_done INTEGER,
+                updated REAL
+            )""")
+        self.db.commit()
+
+    def claim(self, key, ttl):
+        """Take or renew a lease, False while another worker holds a live one"""
+        now = time.time()
+        row = self.db.execute('SELECT owner, expires FROM leases WHERE key = ?',
+                              (key,)).fetchone()
+        with self.db:
+            cur = self.db.execute("""
+                INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    owner = excluded.owner, expires = excluded.expires
+                WHERE leases.owner = excluded.owner OR leases.expires < ?
+                """, (key, self.owner, now + ttl, now))
+        if cur.rowcount != 1:
+            return False
+        if row is not None and row[0] != self.owner:
+            report.count('lease_reclaimed')
+        return True
+
+    def renew(self, ttl):
+        """Push back the expiry of every lease this worker holds"""
+        with self.db:
+            self.db.execute('UPDATE leases SET expires = ? WHERE owner = ?',
+                            (time.time() + ttl, self.owner))
+
+    def release(self, key):
+        with self.db:
+            self.db.execute('DELETE FROM leases WHERE key = ? AND owner = ?',
+                            (key, self.owner))
+
+    def release_all(self):
+        with self.db:
+            self.db.execute('DELETE FROM leases WHERE owner = ?', (self.owner,))
+
+    def priority_holders(self):
+        """Other workers currently downloading new episodes"""
+        row = self.db.execute("""
+            SELECT count(*) FROM leases
+            WHERE key LIKE 'priority:%' AND owner != ? AND expires >= ?""",
+                              (self.owner, time.time())).fetchone()
+        return row[0]
+
+    def live_leases(self):
+        """owner -> number of unexpired leases"""
+        return dict(self.db.execute(
+            'SELECT owner, count(*) FROM leases WHERE expires >= ? GROUP BY owner',
+            (time.time(),)).fetchall())
+
+    def record_shard(self, shard, shows, shows_done, episodes, episodes_done):
+        """Store how far a catch-up shard has got"""
+        with self.db:
+            self.db.execute("""
+                INSERT INTO shard_progress VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(shard) DO UPDATE SET
+                    owner = excluded.owner, shows = excluded.shows,
+                    shows_done = excluded.shows_done, episodes = excluded.episodes,
+                    episodes_done = excluded.episodes_done, updated = excluded.updated
+                """, (shard, self.owner, shows, shows_done, episodes, episodes_done,
+                      time.time()))
+
+    def shard_progress(self):
+        return self.db.execute("""
+            SELECT shard, owner, shows, shows_done, episodes, episodes_done, updated
+            FROM shard_progress ORDER BY shard""").fetchall()
+
+    def show_qualities(self):
+        """url -> (quality, last full probe) for every show seen"""
+        rows = self.db.execute('SELECT url, quality, probed FROM show_quality').fetchall()
+        return dict((url, (quality, probed)) for (url, quality, probed) in rows)
+
+    def record_quality(self, url, quality, probes, seconds, full_probe):
+        """Remember the quality an episode negotiated and what it cost"""
+        now = time.time()
+        with self.db:
+            self.db.execute('INSERT INTO quality_probes VALUES (?, ?, ?, ?, ?)',
+                            (now, url, quality, probes, seconds))
+            if full_probe:
+                self.db.execute("""
+                    INSERT INTO show_quality (url, quality, probed) VALUES (?, ?, ?)
+                    ON CONFLICT(url) DO UPDATE SET
+                        quality = excluded.quality, probed = excluded.probed
+                    """, (url, quality, now))
+            else:
+                self.db.execute("""
+                    INSERT INTO show_quality (url, quality, probed) VALUES (?, ?, 0)
+                    ON CONFLICT(url) DO UPDATE SET quality = excluded.quality
+                    """, (url, quality))
+
+    def probe_stats(self, since=0):
+        """Episodes negotiated, qualities probed and seconds spent since a time"""
+        return self.db.execute("""
+            SELECT count(*), coalesce(sum(probes), 0), coalesce(sum(seconds), 0)
+            FROM quality_probes WHERE stamp >= ?""", (since,)).fetchone()
+
+    def record_poll(self, changed):
+        """Remember when the feed was polled and whether it had changed"""
+        with self.db:
+            self.db.execute('INSERT INTO feed_polls (polled, changed) VALUES (?, ?)',
+                            (time.time(), int(changed)))
+
+    def feed_changes(self, since):
+        """Times the feed was seen to change since a timestamp"""
+        rows = self.db.execute('SELECT polled FROM feed_polls WHERE changed = 1 AND polled >= ?',
+                               (since,)).fetchall()
+        return [row[0] for row in rows]
+
+    def unchanged_streak(self):
+        """Number of unchanged polls since the last change"""
+        row = self.db.execute("""
+            SELECT count(*) FROM feed_polls
+            WHERE polled > (SELECT coalesce(max(polled), 0) FROM feed_polls WHERE changed = 1)
+            """).fetchone()
+        return row[0]
+
+    def needs_processing(self, guid):
+        """New entries, and failures that have retries left"""
+        row = self.db.execute('SELECT status, attempts FROM entries WHERE guid = ?',
+                              (guid,)).fetchone()
+        if row is None:
+            return True
+        status, attempts = row
+        if status in self.done:
+            return False
+        if status in self.retry:
+            return attempts < self.retry_limit
+        # not_monitored, no_space and host_down don't use up a retry
+        return True
+
+    def is_settled(self, guid):
+        """False for entries still owed a download: unseen, retrying or deferred"""
+        row = self.db.execute('SELECT status, attempts FROM entries WHERE guid = ?',
+                              (guid,)).fetchone()
+        if row is None:
+            return False
+        status, attempts = row
+        if status in self.retry:
+            return attempts >= self.retry_limit
+        return status not in self.deferred
+
+    def pending_retries(self, days=7):
+        """Entries from the last few days still owed a download"""
+        marks = ','.join('?' * len(self.retry))
+        row = self.db.execute("""
+            SELECT count(*) FROM entries WHERE updated >= ? AND (
+                (status IN ({}) AND attempts < ?) OR status IN ({}))""".format(
+                    marks, ','.join('?' * len(self.deferred))),
+            (time.time() - days * 86400,) + self.retry + (self.retry_limit,)
+            + self.deferred).fetchone()
+        return row[0]
+
+    def record(self, guid, show, ep_num, status):
+        """Store the outcome of processing an entry"""
+        now = time.time()
+        attempts = 1 if status in self.retry else 0
+        if not attempts:
+            # not_monitored entries come round every poll, skip the commit
+            row = self.db.execute('SELECT status FROM entries WHERE guid = ?',
+                                  (guid,)).fetchone()
+            if row is not None and row[0] == status:
+                return
+        with self.db:
+            self.db.execute("""
+                INSERT INTO entries (guid, show, ep_num, status, attempts, first_seen, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(guid) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = entries.attempts + excluded.attempts,
+                    updated = excluded.updated
+                """, (guid, show, str(ep_num), status, attempts, now, now))
+
+    def stats(self, days=14):
+        """Entry counts by status and downloads per day"""
+        by_status = dict(self.db.execute(
+            'SELECT status, count(*) FROM entries GROUP BY status').fetchall())
+        per_day = self.db.execute("""
+            SELECT date(updated, 'unixepoch', 'localtime') AS day, count(*)
+            FROM entries WHERE status = 'downloaded'
+            GROUP BY day ORDER BY day DESC LIMIT ?""", (days,)).fetchall()
+        return by_status, per_day
+
+    def close(self):
+        self.db.close()
+
+
+class FeedEntry(dict):
+    """One rss item, read the way a feedparser entry is"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FeedItems:
+    """Parser target that turns rss items into entries as they close"""
+    fields = {'title': 'title', 'link': 'link', 'guid': 'id', 'pubDate': 'published'}
 
     def __init__(self):
-        return
+        self.path = []
+        self.text = []
+        self.item = None
+        self.items = collections.deque()
+        self.title = ''
+
+    def start(self, tag, attrib):
+        self.path.append(tag.rsplit('}', 1)[-1])
+        self.text = []
+        if self.path[-1] == 'item':
+            self.item = FeedEntry(tags=[])
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, tag):
+        tag = self.path.pop()
+        text = ''.join(self.text).strip()
+        self.text = []
+        parent = self.path[-1] if self.path else None
+        if tag == 'item' and self.item is not None:
+            self.items.append(self.item)
+            self.item = None
+        elif parent == 'item' and self.item is not None:
+            if tag == 'category':
+                self.item['tags'].append({'term': text})
+            elif tag in self.fields:
+                self.item[self.fields[tag]] = text
+        elif parent == 'channel' and tag == 'title':
+            self.title = text
+
+    def close(self):
+        return None
 
-    def load_rss(self):
-        self.rss = feedparser.parse(self.url)
-        if 'title' in self.rss.feed and 'AnimeRush' in self.rss.feed.title:
+
+entity_re = re.compile(rb'&([A-Za-z][A-Za-z0-9]*);')
+bare_amp_re = re.compile(rb'&(?!#[0-9]+;|#x[0-9a-fA-F]+;|[A-Za-z][A-Za-z0-9]*;)')
+
+
+def xml_entities(chunk):
+    """Turn html named entities expat does not know into character references,
+    and escape ampersands that start no entity at all"""
+    from html.entities import name2codepoint
+
+    def sub(m):
+        name = m.group(1).decode()
+        if name in ('amp', 'lt', 'gt', 'quot', 'apos'):
+            return m.group(0)
+        if name not in name2codepoint:
+            # kept as text, like a browser shows it
+            return b'&amp;' + m.group(1) + b';'
+        return b'&#%d;' % name2codepoint[name]
+    return entity_re.sub(sub, bare_amp_re.sub(b'&amp;', chunk))
+
+
+class AnimeRushRSS:
+    url = 'http://www.animerush.tv/rss.xml'
+    changed = True
+    # set once the feed is read to its end or to the last run's newest entry
+    complete = False
+    response = None
+
+    def __init__(self, state_file=None, url=None):
+        if url is not None:
+            self.url = url
+        self.state_file = state_file
+        self.state = dict()
+        if state_file is None or not os.path.exists(state_file):
+            return
+        try:
+            with open(state_file, 'r') as stream:
+                self.state = json.load(stream)
+        except (OSError, ValueError):
+            self.state = dict()
+
+    def save_state(self):
+        """Persist validators and poll counters for the next run"""
+        if self.state_file is None:
+            return
+        with atomic_write(self.state_file) as stream:
+            json.dump(self.state, stream)
+
+    def load_rss(self, conditional=True):
+        """Fetch the feed, conditional on the last ETag/Last-Modified"""
+        headers = dict()
+        if conditional and self.state.get('etag'):
+            headers['If-None-Match'] = self.state['etag']
+        if conditional and self.state.get('modified'):
+            headers['If-Modified-Since'] = self.state['modified']
+        x = get_session().get(self.url, headers=headers, stream=True)
+        self.state['polls'] = self.state.get('polls', 0) + 1
+
+        if x.status_code == 304:
+            x.close()
+            self.changed = False
+            self.state['unchanged'] = self.state.get('unchanged', 0) + 1
+            self.save_state()
+            return True
+
+        self.changed = True
+        # the body is parsed as it arrives, get_entries reads on from here
+        from xml.etree import ElementTree
+        self.response = x
+        self.chunks = x.iter_content(chunk_size=16384)
+        self.carry = b''
+        self.target = FeedItems()
+        self.parser = ElementTree.XMLParser(target=self.target)
+        self.seen = []
+        # saved by mark_read, once the whole feed has been read
+        self.validators = (x.headers.get('ETag'), x.headers.get('Last-Modified'))
+        while not self.target.title and not self.target.items and self._fill():
+            pass
+        if 'AnimeRush' in self.target.title:
+            self.save_state()
             return True
+        self.save_state()
         return False
 
+    def poll_summary(self):
+        """Human readable changed/unchanged line for the run log"""
+        polls = self.state.get('polls', 0)
+        unchanged = self.state.get('unchanged', 0)
+        if self.changed:
+            status = '[green]Feed changed'
+        else:
+            status = '[yellow]Feed unchanged (304)'
+        return '{}, {} of {} polls unchanged'.format(status, unchanged, polls)
+
     def show_name(self, episode):
         """Return the show name only"""
         # return re.sub(re.compile(' *episode *[0-9]*'), '', title)
@@ -52,75 +744,440 @@ class AnimeRushRSS:
         """Return the episode number only"""
         return re.sub(re.compile('.* episode *'), '', episode.title)
 
-    def get_entries(self):
-        """Just return the entries list"""
-        return self.rss.entries
+    def _fill(self):
+        """Parse the next chunk of the feed, False once there is no more"""
+        from xml.etree import ElementTree
+        if self.response is None:
+            return False
+        chunk = next(self.chunks, None)
+        try:
+            if chunk is None:
+                self.parser.feed(xml_entities(self.carry))
+                self.parser.close()
+                self._finish()
+                self.complete = True
+                return False
+            chunk = self.carry + chunk
+            # keep a possibly split entity back for the next chunk
+            cut = chunk.rfind(b'&')
+            if cut != -1 and b';' not in chunk[cut:] and len(chunk) - cut < 32:
+                (chunk, self.carry) = (chunk[:cut], chunk[cut:])
+            else:
+                self.carry = b''
+            self.parser.feed(xml_entities(chunk))
+        except ElementTree.ParseError as e:
+            print('[bold red]Feed parse error: ' + str(e))
+            self._finish()
+            # the entries past the error were never read, fetch it all next time
+            self.state.pop('etag', None)
+            self.state.pop('modified', None)
+            self.save_state()
+            return False
+        return True
+
+    def _finish(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
 
+    def get_entries(self):
+        """Yield entries newest first, up to the newest one of the last run"""
+        if not self.changed:
+            return
+        while True:
+            while self.target.items:
+                e = self.target.items.popleft()
+                if self.guid(e) == self.state.get('last_guid'):
+                    # everything from here down was settled last time
+                    self._finish()
+                    self.complete = True
+                    return
+                self.seen.append(self.guid(e))
+                yield e
+            if not self._fill():
+                return
+
+    def mark_read(self, state):
+        """Remember where to stop next time, once the feed was read through
+        and every entry in it is settled"""
+        if not self.changed:
+            return
+        if self.seen:
+            report.count('feed_entries_read', len(self.seen))
+        # a feed cut short or broken part way keeps the old stop point and
+        # validators, the entries past the break are read again next time
+        if not self.complete:
+            report.count('feed_incomplete')
+            return
+        # entries left for a retry keep the old stop point so they are read again
+        if not all(state.is_settled(guid) for guid in self.seen):
+            return
+        if self.seen:
+            self.state['last_guid'] = self.seen[0]
+        (self.state['etag'], self.state['modified']) = self.validators
+        self.save_state()
+
+    def guid(self, episode):
+        """Stable key for an entry, the guid or failing that the link"""
+        return episode.get('id') or episode.link
+
+
+season_bits = [
+    '0th', '1st', '2nd', '3rd', '4th', '5th', '6th', '7th', '8th', '9th',
+]
+ordinal_season_res = [re.compile(' *' + sea + ' Season') for sea in season_bits]
+numbered_season_res = [
+    (i,
+     re.compile(' *Season ' + str(i)),
+     ' S' + str(i), re.compile(r' \(*S' + str(i) + r'\)*$'),
+     ' ' + str(i), re.compile(' ' + str(i) + '$'))
+    for i in range(1, 9)
+]
+ova_re = re.compile(' OVA')
+special_re = re.compile(' Specials*')
+
+
+def normalize_title(title):
+    """Split a homepage title into directory name and season number"""
+    season = 1
+    name = title.encode("ascii", 'ignore').decode()
+    name = name.replace('/', '+')
+
+    # removing text never brings ' Season' back, so stop once it is gone
+    for (i, sea_re) in enumerate(ordinal_season_res):
+        if ' Season' not in name:
+            break
+        season = i
+        name = sea_re.sub('', name)
+
+    for (i, ss_re, s_end, s_re, n_end, n_re) in numbered_season_res:
+        if 'ss' in name:
+            season = i
+            name = ss_re.sub('', name)
+        if name.endswith(s_end):
+            season = i
+            name = s_re.sub('', name)
+        if name.endswith(n_end):
+            season = i
+            name = n_re.sub('', name)
+
+    if 'OVA' in name:
+        season = 0
+        name = ova_re.sub('', name)
+    if 'Special' in name:
+        season = 0
+        name = special_re.sub('', name)
+    return name, season
 
 
 class AnimeRushOngoing:
     url = 'https://www.animerush.tv/'
-    ongoing_list = []
-
-    def __init__(self):
-        return
+    # url -> (fetched, html), shared by every instance in this process
+    page_cache = dict()
+
+    def __init__(self, cache_file=None, ttl=0, url=None):
+        if url is not None:
+            self.url = url
+        self.cache_file = cache_file
+        self.ttl = ttl
+
+    def _cached_html(self):
+        cached = self.page_cache.get(self.url)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
+        fetched = os.stat(self.cache_file).st_mtime
+        if time.time() - fetched >= self.ttl:
+            return None
+        with open(self.cache_file, 'r') as stream:
+            html = stream.read()
+        self.page_cache[self.url] = (fetched, html)
+        return html
 
     def get_page(self):
-        headers = {
-            "Accept": "*/*",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36",
-        }
-        x = requests.get(self.url, headers=headers)
-        soup = BeautifulSoup(x.text, 'html.parser')
+        html = self._cached_html()
+        if html is None:
+            x = get_session().get(self.url)
+            # an error page would be cached as an empty list for the whole ttl
+            x.raise_for_status()
+            html = x.text
+            if 'airing_box_mid_link' not in html:
+                # a maintenance page, parse it but don't keep it
+                return self.parse_page(html)
+            self.page_cache[self.url] = (time.time(), html)
+            if self.cache_file is not None:
+                with atomic_write(self.cache_file) as stream:
+                    stream.write(html)
+        return self.parse_page(html)
+
+    def parse_page(self, html):
+        """Parse just the airing boxes, skip building the rest of the tree"""
+        from bs4 import BeautifulSoup, SoupStrainer
+        strainer = SoupStrainer('div', attrs={'class': 'airing_box_mid_link'})
+        soup = BeautifulSoup(html, html_parser, parse_only=strainer)
 
         return soup
 
     def build_list(self, soup):
-        season_bits = [
-            '0th', '1st', '2nd', '3rd', '4th', '5th', '6th', '7th', '8th', '9th',
-        ]
+        """The shows on the page, once each, keyed and ordered by full name"""
+        ongoing = dict()
         for anime in soup.find_all('div', attrs={'class': 'airing_box_mid_link'}):
-            anime_descendants = anime.descendants
-            for d in anime_descendants:
-                if d.name == 'a' and d.get('class', '') == ['full_click']:
-                    a_dict = dict()
-                    season = 1
-                    fix_str = d.text.encode("ascii", 'ignore')
-                    name = fix_str.decode()
-                    name = name.replace('/', '+')
-                    for (i, sea) in enumerate(season_bits):
-                        if ' Season' in name:
-                            season = i
-                            name = re.sub(re.compile(' *' + sea + ' Season'), '', name)
-                    for i in range(1, 9):
-                        ss = 'Season ' + str(i)
-                        if 'ss' in name:
-                            season = i
-                            name = re.sub(re.compile(' *' + ss), '', name)
-                        if name.endswith(' S' + str(i)):
-                            season = i
-                            name = re.sub(re.compile(' \(*S' + str(i) + '\)*$'), '', name)
-                        if name.endswith(' ' + str(i)):
-                            season = i
-                            name = re.sub(re.compile(' ' + str(i) + '$'), '', name)
-                    if 'OVA' in name:
-                        season = 0
-                        name = re.sub(re.compile(' OVA'), '', name)
-                    if 'Special' in name:
-                        season = 0
-                        name = re.sub(re.compile(' Specials*'), '', name)
-                    a_dict['full_name'] = d.text
-                    if not d['href'].startswith('http'):
-                        a_dict['url'] = 'https:' + d['href']
-                    else:
-                        a_dict['url'] = d['href']
-                    a_dict['name'] = name
-                    a_dict['season'] = season
-                    self.ongoing_list.append(a_dict)
-
+            for d in anime.find_all('a', attrs={'class': 'full_click'}):
+                if d.get('class', '') != ['full_click']:
+                    continue
+                a_dict = dict()
+                name, season = normalize_title(d.text)
+                a_dict['full_name'] = d.text
+                if not d['href'].startswith('http'):
+                    a_dict['url'] = 'https:' + d['href']
+                else:
+                    a_dict['url'] = d['href']
+                a_dict['name'] = name
+                a_dict['season'] = season
+                ongoing.setdefault(a_dict['full_name'], a_dict)
+
+        self.ongoing_list = list(ongoing.values())
         return self.ongoing_list
 
 
+class OngoingSnapshot:
+    """The ongoing list as seen last time, by full name"""
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.taken = None
+        self.shows = dict()
+        if state_file is None or not os.path.exists(state_file):
+            return
+        try:
+            with open(state_file, 'r') as stream:
+                snapshot = json.load(stream)
+            self.taken = snapshot['taken']
+            self.shows = snapshot['shows']
+        except (OSError, ValueError, KeyError):
+            self.shows = dict()
+
+    def diff(self, ogl):
+        """Shows (added, removed) since the snapshot, in page order"""
+        current = dict((anime['full_name'], anime) for anime in ogl)
+        added = [name for name in current if name not in self.shows]
+        removed = [name for name in self.shows if name not in current]
+        return added, removed
+
+    def save(self, ogl):
+        self.taken = time.time()
+        self.shows = dict((anime['full_name'], {'url': anime['url'], 'name': anime['name'],
+                                                'season': anime['season']})
+                          for anime in ogl)
+        if self.state_file is None:
+            return
+        with atomic_write(self.state_file) as stream:
+            json.dump({'taken': self.taken, 'shows': self.shows}, stream)
+
+
+http_headers = {
+    "Accept": "*/*",
+    "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36",
+}
+_session = None
+
+
+class HostDown(requests.ConnectionError):
+    """Raised instead of a request to a host whose circuit breaker is open"""
+
+
+class CircuitBreakers:
+    """Consecutive failures per host, a host that keeps failing is skipped
+    until its cooldown runs out, kept in a file so later runs skip it too"""
+
+    def __init__(self, state_file=None, threshold=5, cooldown=300, max_cooldown=3600):
+        self.state_file = state_file
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.hosts = dict()
+        if state_file is None or not os.path.exists(state_file):
+            return
+        try:
+            with open(state_file, 'r') as stream:
+                self.hosts = json.load(stream)
+        except (OSError, ValueError):
+            self.hosts = dict()
+
+    def save(self):
+        if self.state_file is None:
+            return
+        with atomic_write(self.state_file) as stream:
+            json.dump(self.hosts, stream)
+
+    def allow(self, host):
+        """False while the host's breaker is open"""
+        with self.lock:
+            entry = self.hosts.get(host)
+            return entry is None or entry.get('open_until', 0) <= time.time()
+
+    def open_until(self, host):
+        with self.lock:
+            return self.hosts.get(host, {}).get('open_until', 0)
+
+    def success(self, host):
+        with self.lock:
+            entry = self.hosts.pop(host, None)
+            if entry is None:
+                return
+            if entry['failures'] >= self.threshold:
+                print('[green]{} is answering again'.format(host))
+            self.save()
+
+    def failure(self, host):
+        with self.lock:
+            entry = self.hosts.setdefault(host, {'failures': 0, 'cooldown': self.cooldown})
+            entry['failures'] = entry['failures'] + 1
+            # requests already in flight when it opened
+            if entry['failures'] < self.threshold or entry.get('open_until', 0) > time.time():
+                return
+            # a half open host that fails again waits twice as long
+            entry['open_until'] = time.time() + entry['cooldown']
+            print('[bold red]{} keeps failing, skipping it for {} seconds'.format(
+                host, int(entry['cooldown'])))
+            entry['cooldown'] = min(entry['cooldown'] * 2, self.max_cooldown)
+            report.count('breaker_tripped')
+            self.save()
+
+
+class ResilientAdapter(HTTPAdapter):
+    """Retries transient failures with jittered exponential backoff and fails
+    fast for hosts whose breaker is open"""
+    transient = (429, 500, 502, 503, 504)
+
+    def __init__(self, breakers, attempts=3, backoff=0.5, max_backoff=30, timeout=(10, 30),
+                 **kwargs):
+        self.breakers = breakers
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # (connect, read), a dead host costs the connect timeout only
+        self.timeout = timeout
+        super().__init__(max_retries=0, **kwargs)
+
+    def delay(self, attempt, response=None):
+        """Full jitter, or what the host asked for in Retry-After"""
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(int(response.headers['Retry-After']), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).netloc
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        for attempt in range(self.attempts):
+            if not self.breakers.allow(host):
+                report.count('breaker_skipped')
+                raise HostDown('{} is down, skipped until {}'.format(
+                    host, time.strftime('%H:%M:%S',
+                                        time.localtime(self.breakers.open_until(host)))),
+                    request=request)
+            response = None
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.breakers.failure(host)
+                if attempt + 1 == self.attempts:
+                    raise
+            else:
+                if response.status_code not in self.transient:
+                    self.breakers.success(host)
+                    return response
+                self.breakers.failure(host)
+                if attempt + 1 == self.attempts:
+                    return response
+                response.close()
+            report.count('http_retries')
+            time.sleep(self.delay(attempt, response))
+
+
+def get_session(config=None):
+    """Return the shared pooled session, building it on first use"""
+    global _session
+    if _session is not None:
+        return _session
+    if config is None:
+        config = dict()
+    session = requests.Session()
+    session.headers.update(http_headers)
+    breaker_file = None
+    if 'base_directory' in config:
+        breaker_file = state_path(config, 'breakers.json')
+    breakers = CircuitBreakers(breaker_file,
+                               threshold=config.get('breaker_threshold', 5),
+                               cooldown=config.get('breaker_cooldown', 300),
+                               max_cooldown=config.get('breaker_max_cooldown', 3600))
+    adapter = ResilientAdapter(breakers,
+                               attempts=config.get('retry_attempts', 3),
+                               backoff=config.get('retry_backoff', 0.5),
+                               max_backoff=config.get('retry_max_backoff', 30),
+                               timeout=(config.get('http_connect_timeout', 10),
+                                        config.get('http_timeout', 30)),
+                               pool_connections=config.get('pool_connections', 10),
+                               pool_maxsize=config.get('pool_maxsize', 20))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _session = session
+    return _session
+
+
+def install_session(config):
+    """Build the shared session with the pool sizes from the config,
+    replacing any session an earlier config built"""
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+    return get_session(config)
+
+
+def use_shared_session():
+    """Point anime_downloader at the shared session, importing it on first use"""
+    from anime_downloader import session as ad_session
+    if getattr(ad_session, 'shared_session', None) is not None:
+        return
+    # helpers.get() asks for a fresh cached session on every request,
+    # looked up each time so a reloaded config's session takes over
+    ad_session.get_session = lambda custom_session=None, cache=True: get_session()
+    ad_session.shared_session = get_session()
+
+
+def animerush_classes():
+    """The series and episode classes episodes are scraped with"""
+    from anime_downloader.sites.animerush import AnimeRush, AnimeRushEpisode
+    use_shared_session()
+    return AnimeRush, AnimeRushEpisode
+
+
+def get_ongoing(config):
+    """Fetch and parse the homepage, reusing it for homepage_ttl seconds"""
+    aro = AnimeRushOngoing(state_path(config, 'homepage.html'),
+                           ttl=config.get('homepage_ttl', 900),
+                           url=config.get('site_url'))
+    with report.phase('get_page'):
+        soup = aro.get_page()
+    with report.phase('build_list'):
+        return aro.build_list(soup)
+
+
+def shard_arg(value):
+    """Parse N/M for --shard"""
+    try:
+        (number, count) = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected N/M, e.g. 1/4')
+    if count < 1 or not 1 <= number <= count:
+        raise argparse.ArgumentTypeError('shard number must be between 1 and M')
+    return (number, count)
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--directory', action='store',
@@ -132,12 +1189,18 @@ def parse_args():
     parser.add_argument('-p', '--pick_anime', action='store_true',
                         dest='pick_anime', default=False,
                         help='Pick Anime to monitor')
+    parser.add_argument('--batch', action='store_true',
+                        dest='batch', default=False,
+                        help='With -p, pick by pick_rules only, never prompt')
     parser.add_argument('-i', '--initial_download_all', action='store_true',
                         dest='initial_download_all', default=False,
                         help='Perform an initial download of all monitored anime')
     parser.add_argument('-s', '--single_initial_download', action='store_true',
                         dest='single_initial_download', default=False,
                         help='Perform an initial download of one monitored anime')
+    parser.add_argument('--shard', action='store',
+                        dest='shard', default=None, type=shard_arg,
+                        help='With -i or --plan, only take shard N of M (N/M)')
     parser.add_argument('-a', '--ask-initial',
                         action='store_true',
                         dest='ask_initial',
@@ -146,21 +1209,110 @@ def parse_args():
     parser.add_argument('-n', '--new_anime_check', action='store_true',
                         dest='new_anime_check', default=False,
                         help='Check for new anime')
+    parser.add_argument('--daemon', action='store_true',
+                        dest='daemon', default=False,
+                        help='Keep running and poll the RSS feed')
+    parser.add_argument('--pipeline', action='store_true',
+                        dest='pipeline', default=False,
+                        help='Fetch, resolve and download concurrently in the default run')
+    parser.add_argument('--plan', action='store', nargs='?', const='',
+                        dest='plan', default=None, metavar='FILE',
+                        help='Write a JSON plan of missing episodes, download nothing')
+    parser.add_argument('--run-plan', action='store', nargs='?', const='',
+                        dest='run_plan', default=None, metavar='FILE',
+                        help='Download the episodes of a plan written by --plan')
+    parser.add_argument('--stats', action='store_true',
+                        dest='stats', default=False,
+                        help='Show statistics from the state database')
     args = parser.parse_args()
     return args
 
 
+def state_path(config, name):
+    """Return the path of a state file, creating the state directory"""
+    sdir = config.get('state_directory',
+                      config['base_directory'] + '/.animerush_rss')
+    os.makedirs(sdir, exist_ok=True)
+    return sdir + '/' + name
+
+
+def yaml_loader_dumper():
+    """The libyaml loader and dumper when available, pure python otherwise"""
+    import yaml
+    try:
+        return yaml, yaml.CSafeLoader, yaml.CSafeDumper
+    except AttributeError:
+        return yaml, yaml.SafeLoader, yaml.SafeDumper
+
+
+def config_cache_file(conf_f):
+    """Where the compiled copy of a config file lives"""
+    head, tail = os.path.split(os.path.abspath(conf_f))
+    return head + '/.' + tail + '.cache'
+
+
+def save_config_cache(conf_f, config, st, digest):
+    record = {
+        'python': list(sys.version_info[:2]),
+        'mtime': st.st_mtime_ns,
+        'size': st.st_size,
+        'sha1': digest,
+        'config': config,
+    }
+    cache_f = config_cache_file(conf_f)
+    try:
+        with atomic_write(cache_f, 'wb') as stream:
+            marshal.dump(record, stream)
+    except (OSError, ValueError):
+        # a read only config directory just means no cache
+        pass
+
+
+def load_config_cache(conf_f):
+    try:
+        with open(config_cache_file(conf_f), 'rb') as stream:
+            record = marshal.load(stream)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(record, dict) or record.get('python') != list(sys.version_info[:2]):
+        return None
+    return record
+
+
 def parse_config(conf_f):
-    """Parse the config file"""
+    """Parse the config file, from its compiled cache when unchanged"""
     if not os.path.exists(conf_f):
         return None
-    with open(conf_f, 'r') as stream:
-        try:
-            parsed_yaml=yaml.safe_load(stream)
-            return parsed_yaml
-        except yaml.YAMLError as exc:
-            print(exc)
-    return None
+    st = os.stat(conf_f)
+    cached = load_config_cache(conf_f)
+    if cached is not None and cached['mtime'] == st.st_mtime_ns and cached['size'] == st.st_size:
+        return cached['config']
+
+    with open(conf_f, 'rb') as stream:
+        raw = stream.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    if cached is not None and cached['sha1'] == digest:
+        # touched but not changed
+        save_config_cache(conf_f, cached['config'], st, digest)
+        return cached['config']
+
+    yaml, loader, dumper = yaml_loader_dumper()
+    try:
+        parsed_yaml = yaml.load(raw, Loader=loader)
+    except yaml.YAMLError as exc:
+        print(exc)
+        return None
+    save_config_cache(conf_f, parsed_yaml, st, digest)
+    return parsed_yaml
+
+
+def save_config(config, conf_f):
+    """Write the config file atomically and refresh its cache"""
+    yaml, loader, dumper = yaml_loader_dumper()
+    raw = yaml.dump(config, Dumper=dumper).encode()
+    with atomic_write(conf_f, 'wb', sync=True) as stream:
+        stream.write(raw)
+    save_config_cache(conf_f, config, os.stat(conf_f), hashlib.sha1(raw).hexdigest())
 
 
 def fix_config(current_anime, conf_f):
@@ -178,37 +1330,138 @@ def fix_config(current_anime, conf_f):
 
     # all fixes applied, save config
     if changed:
-        with open(conf_f, 'w') as file:
-            yaml.dump(current_anime, file)
+        save_config(current_anime, conf_f)
         print('[green]Applied fixes to config file ' + conf_f)
 
     # return config in case we changed it
     return current_anime
 
 
-def find_anime_in_monitored_list(anime_name, mlist):
-    """Return the dict of the monitored anime if any."""
-    for a in mlist:
-        if a['full_name'] == anime_name:
-            return a
-    return None
-
-
-def new_anime_check(current_anime):
-    # fetch the current list
-    aro = AnimeRushOngoing()
-    soup = aro.get_page()
-    ogl = aro.build_list(soup)
+def ongoing_changes(config, registry, ogl=None):
+    """Diff the ongoing list against the last snapshot and the monitored list,
+    return (unknown, added, removed) show names"""
+    # fetch the current list, unless the caller already has it
+    if ogl is None:
+        ogl = get_ongoing(config)
+    if not ogl:
+        # no airing boxes is a broken page, not every show ending at once
+        print('[bold red]No ongoing anime on the homepage, keeping the last snapshot')
+        report.count('ongoing_empty')
+        return [], [], []
+    snapshot = OngoingSnapshot(state_path(config, 'ongoing.json'))
+    added, removed = snapshot.diff(ogl)
+    unknown = [anime['full_name'] for anime in ogl if anime['full_name'] not in registry]
+    snapshot.save(ogl)
+    report.count('ongoing_added', len(added))
+    report.count('ongoing_removed', len(removed))
+    return unknown, added, removed
+
+
+def new_anime_check(config, registry, ogl=None):
+    """Report what changed on the ongoing list, True if a show isn't in the config"""
+    unknown, added, removed = ongoing_changes(config, registry, ogl)
+    if added or removed:
+        print('[yellow]Ongoing list: {} added, {} removed since the last check'.format(
+            len(added), len(removed)))
+    for name in added:
+        print('[green]  + ' + name)
+    for name in removed:
+        print('[yellow]  - ' + name)
+    for name in unknown:
+        print('[bold green]  new: ' + name)
+    return len(unknown) > 0
+
+
+class PickRules:
+    """config['pick_rules']: include/exclude regexes and seasons for picking
+    shows without asking"""
+
+    def __init__(self, rules):
+        rules = rules or dict()
+        try:
+            self.include = [re.compile(r, re.I) for r in rules.get('include', [])]
+            self.exclude = [re.compile(r, re.I) for r in rules.get('exclude', [])]
+        except re.error as e:
+            raise ValueError('Bad regex in pick_rules: {}'.format(str(e)))
+        self.seasons = rules.get('seasons')
+        self.season_offset = rules.get('season_offset', 0)
+        # keep: left for the next -p, unmonitored: recorded as not monitored
+        self.leftovers = rules.get('leftovers', 'keep')
+
+    def verdict(self, anime):
+        """True to monitor, False to skip, None when no rule decides"""
+        if any(r.search(anime['full_name']) for r in self.exclude):
+            return False
+        # a season outside the list is left for the operator
+        if self.seasons is not None and anime['season'] not in self.seasons:
+            return None
+        if any(r.search(anime['full_name']) for r in self.include):
+            return True
+        return None
 
+    def entry(self, anime, monitored):
+        """Config entry for a show, directory and season as parsed from the title"""
+        new_entry = dict()
+        new_entry['full_name'] = anime['full_name']
+        new_entry['monitored'] = monitored
+        if monitored:
+            new_entry['name'] = anime['name']
+            new_entry['season'] = anime['season']
+            new_entry['season_offset'] = self.season_offset
+            new_entry['url'] = anime['url']
+        return new_entry
+
+
+def pick_by_rules(current_anime, registry, ogl, batch):
+    """Apply pick_rules to the shows not in the config, one checkbox for the rest"""
+    rules = PickRules(current_anime.get('pick_rules'))
+    picked = []
+    skipped = []
+    leftovers = []
     for anime in ogl:
-        record = find_anime_in_monitored_list(anime['full_name'],
-                                              current_anime['monitored'])
-        if record is None:
-            return True
-    return False
+        if anime['full_name'] in registry:
+            continue
+        verdict = rules.verdict(anime)
+        if verdict is None:
+            leftovers.append(anime)
+        elif verdict:
+            picked.append(anime)
+        else:
+            skipped.append(anime)
 
+    if leftovers and not batch:
+        from PyInquirer import prompt
+        q_pick = [
+            {
+                'type': 'checkbox',
+                'name': 'picked',
+                'message': 'Monitor which of these?',
+                'choices': [{'name': '{} (season {})'.format(a['full_name'], a['season']),
+                             'value': a['full_name']} for a in leftovers],
+            }
+        ]
+        chosen = set(prompt(q_pick)['picked'])
+        picked.extend(a for a in leftovers if a['full_name'] in chosen)
+        skipped.extend(a for a in leftovers if a['full_name'] not in chosen)
+        leftovers = []
+    elif leftovers and rules.leftovers == 'unmonitored':
+        skipped.extend(leftovers)
+        leftovers = []
+
+    for anime in picked:
+        print('[green]Monitoring: [/green][yellow]{} [/yellow]-> {} season {}'.format(
+            anime['full_name'], anime['name'], anime['season']))
+        registry.add(rules.entry(anime, True))
+    for anime in skipped:
+        registry.add(rules.entry(anime, False))
+    for anime in leftovers:
+        print('[yellow]No rule for: ' + anime['full_name'])
+    print('[green]{} monitored, {} skipped, {} left for the next -p'.format(
+        len(picked), len(skipped), len(leftovers)))
+    return current_anime
 
-def pick_anime(current_anime, directory):
+
+def pick_anime(current_anime, directory, batch=False):
     """Lets pick some anime to monitor."""
 
     # no config file, make a default
@@ -225,18 +1478,23 @@ def pick_anime(current_anime, directory):
         ]
         current_anime['external_downloader'] = '{aria2}'
 
+    registry = MonitoredRegistry(current_anime['monitored'])
+
     # fetch the current list
-    aro = AnimeRushOngoing()
-    soup = aro.get_page()
-    ogl = aro.build_list(soup)
+    ogl = get_ongoing(current_anime)
+
+    if batch or current_anime.get('pick_rules'):
+        return pick_by_rules(current_anime, registry, ogl, batch)
+
+    from rich.console import Console
+    from PyInquirer import prompt
+    NumberValidator = number_validator()
 
     console = Console()
     console.clear()
 
     for anime in ogl:
-        record = find_anime_in_monitored_list(anime['full_name'],
-                                              current_anime['monitored'])
-        if record is not None:
+        if anime['full_name'] in registry:
             continue
         
         console.clear()
@@ -256,7 +1514,7 @@ def pick_anime(current_anime, directory):
             new_entry = dict()
             new_entry['full_name'] = anime['full_name']
             new_entry['monitored'] = False
-            current_anime['monitored'].append(new_entry)
+            registry.add(new_entry)
             continue
 
         new_entry = dict()
@@ -292,7 +1550,7 @@ def pick_anime(current_anime, directory):
         new_entry['season'] = a_details['season']
         new_entry['season_offset'] = a_details['season_offset']
         new_entry['url'] = anime['url']
-        current_anime['monitored'].append(new_entry)
+        registry.add(new_entry)
 
     return current_anime
 
@@ -327,10 +1585,8 @@ def gen_fullname(anime, basedir, ep_num):
     return filename
 
 
-def have_episode(anime, ep_num, basedir):
-    """Check if episode exists"""
-    # make a list of potential file paths
-    filepaths = []
+def gen_afn(anime):
+    """Generate the underscore name the site uses for downloads"""
     afn_e = anime['full_name'].encode("ascii", 'ignore')
     afn = afn_e.decode()
     afn = afn.replace(' ', '_')
@@ -338,24 +1594,28 @@ def have_episode(anime, ep_num, basedir):
     afn = afn.replace(')', '')
     afn = afn.replace(':', '')
     afn = afn.replace(',', '')
-    
-    filepaths.append(basedir + '/' + gen_seasondir(anime) + '/' + gen_epname(anime, ep_num) + '.mp4')
-    filepaths.append(basedir + '/' + gen_seasondir(anime) + '/' + gen_epname_no_epfill(anime, ep_num) + '.mp4')
-
-    filepaths.append(basedir + '/' + gen_seasondir(anime) + '/' + afn + ' - ' + 'S' + str(anime['season']).zfill(2) + 'E' + str(ep_num) + '.mp4')
-    filepaths.append(basedir + '/' + gen_seasondir(anime) + '/' + afn + ' - ' + 'S' + str(anime['season']).zfill(2) + 'E' + str(ep_num).zfill(2) + '.mp4')
-
-    filepaths.append(basedir + '/' + gen_seasondir(anime) + '/' + afn + '_' + str(ep_num).zfill(2) + '.mp4')
-    filepaths.append(basedir + '/' + gen_seasondir(anime) + '/' + afn + '_' + str(ep_num) + '.mp4')
-    filepaths.append(basedir + '/' + afn + '_' + str(ep_num) + '.mp4')
-    filepaths.append(basedir + '/' + afn + '_' + str(ep_num).zfill(2) + '.mp4')
-
-    # pprint(filepaths)
-    # check them all
-    for path in filepaths:
-        if os.path.exists(path):
+    return afn
+
+
+def have_episode(anime, ep_num, basedir, index):
+    """Check if episode exists"""
+    sdir = basedir + '/' + gen_seasondir(anime)
+    season = str(anime['season']).zfill(2)
+    ep = index.ep_key(ep_num)
+    afn = gen_afn(anime)
+
+    # name - SxxEyy.mp4 (zero filled or not), under either name
+    in_season = index.entries(sdir)
+    for prefix in (anime['name'], afn):
+        if prefix + ' - S' + season + 'E' + ep in in_season:
             return True
 
+    # afn_yy.mp4, in the season directory or the show directory
+    if afn + '_' + ep in in_season:
+        return True
+    if afn + '_' + ep in index.entries(basedir):
+        return True
+
     return False
 
 
@@ -375,66 +1635,993 @@ def create_tree(config, anime):
         os.mkdir(root + '/' + basedir + '/' + sdir)
 
 
-def is_monitored(config, show):
-    """ Do we monitor this anime?"""
-    anime = find_anime_in_monitored_list(show,
-                                        config['monitored'])
-    if anime is None:
-        return False
-    return anime['monitored']
+class QualityCache:
+    """Last quality that worked for each show, tried first next time"""
 
+    def __init__(self, state=None, reprobe_days=7):
+        self.known = dict()
+        if state is not None:
+            self.known = state.show_qualities()
+        self.reprobe = reprobe_days * 86400
 
-def parse_rss(config):
-    """Parse the rss feed, download files"""
-    rss = AnimeRushRSS()
-    rss.load_rss()
-    entries = rss.get_entries()
+    def order(self, config, url):
+        """Return (quality, fallback_qualities, full probe) for a show"""
+        qualities = list(config['fallback_qualities'])
+        if config['quality'] not in qualities:
+            qualities.insert(0, config['quality'])
+        known = self.known.get(url)
+        if known is None or known[0] not in qualities:
+            return config['quality'], qualities, True
+        # now and then start from the top again, the show may have improved
+        if time.time() - known[1] > self.reprobe:
+            return config['quality'], qualities, True
+        start = known[0]
+        return start, [start] + [q for q in qualities if q != start], False
+
+    def update(self, url, quality, full_probe):
+        probed = time.time() if full_probe else self.known.get(url, (None, 0))[1]
+        self.known[url] = (quality, probed)
+
+
+class SeriesCache:
+    """Resolved AnimeRush series objects, shared for series_ttl seconds"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.url_locks = dict()
+        self.series = dict()
+        self.qualities = QualityCache()
+
+    def _url_lock(self, url):
+        with self.lock:
+            if url not in self.url_locks:
+                self.url_locks[url] = threading.Lock()
+            return self.url_locks[url]
+
+    def resolve(self, config, anime):
+        """Return the series for a monitored anime, None if it has no episodes"""
+        AnimeRush = animerush_classes()[0]
+        url = anime['url']
+        ttl = config.get('series_ttl', 3600)
+        # one scrape per url, concurrent callers wait for it
+        with self._url_lock(url):
+            cached = self.series.get(url)
+            if cached is not None and time.time() - cached[0] < ttl:
+                return cached[1]
+            quality, fallbacks, full_probe = self.qualities.order(config, url)
+            try:
+                with report.phase('series_resolve'):
+                    adl = AnimeRush(url, quality=quality,
+                                    fallback_qualities=fallbacks)
+                adl.full_probe = full_probe
+            except IndexError:
+                adl = None
+            self.series[url] = (time.time(), adl)
+            return adl
+
+    def warm(self, config, anime):
+        """Resolve ahead of time, failures surface when the show is resolved again"""
+        try:
+            self.resolve(config, anime)
+        except requests.RequestException:
+            pass
+
+    def prefetch(self, config, animes):
+        """Resolve a batch of anime concurrently"""
+        workers = config.get('resolve_workers', 4)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda anime: self.warm(config, anime), animes))
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+
+series_cache = SeriesCache()
+
+
+class HostLimits:
+    """One semaphore per video host, created on first use"""
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.sems = dict()
+
+    def get(self, host):
+        with self.lock:
+            if host not in self.sems:
+                self.sems[host] = threading.BoundedSemaphore(self.per_host)
+            return self.sems[host]
+
+
+class IncompleteDownload(Exception):
+    """The transfer ended before the advertised size was reached"""
+
+    def __init__(self, have, total):
+        super().__init__('got {} of {} bytes'.format(have, total))
+        self.have = have
+        self.total = total
+
+
+def source_headers(source):
+    """Request headers an extractor needs, as anime_downloader sends them"""
+    headers = dict(source.headers)
+    if 'user-agent' not in headers:
+        headers['user-agent'] = http_headers['user-agent']
+    if source.referer:
+        headers['referer'] = source.referer
+    return headers
+
+
+class TokenBucket:
+    """Blocking byte rate limiter, shared between threads"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1 << 16)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        """Wait until count bytes may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                # a chunk larger than the bucket only has to wait for a full bucket
+                need = min(count, self.burst)
+                if self.tokens >= need:
+                    self.tokens -= need
+                    return
+                wait = (need - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_global_limiter = None
+
+
+def speed_limiters(config):
+    """Rate limiters for one download, per download and global"""
+    global _global_limiter
+    limiters = []
+    if config.get('global_speed_limit'):
+        if _global_limiter is None or _global_limiter.rate != config['global_speed_limit']:
+            _global_limiter = TokenBucket(config['global_speed_limit'])
+        limiters.append(_global_limiter)
+    if config.get('speed_limit'):
+        limiters.append(TokenBucket(config['speed_limit']))
+    return limiters
+
+
+def ep_sort_key(ep_num):
+    """Episode numbers in numeric order, specials between their neighbours"""
+    try:
+        return float(str(ep_num))
+    except ValueError:
+        return float('inf')
+
+
+def existing_dir(path):
+    """The path, or its closest ancestor that exists"""
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+class PriorityGate:
+    """Limiter that holds a catch-up transfer while new episodes download"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def consume(self, count):
+        self.scheduler.wait_turn()
+
+
+class DownloadScheduler:
+    """Transfer order, catch-up backoff and free space admission for one run"""
+    rss = 0
+    catch_up = 1
+
+    def __init__(self, config, jobs=()):
+        self.config = config
+        self.min_free = config.get('min_free_space_mb', 1024) << 20
+        self.cond = threading.Condition()
+        self.active = dict()
+        self.reserved = 0
+        # another worker holds a priority lease
+        self.elsewhere = False
+        self.queued = len(jobs)
+        self.max_queued = self.queued
+        self.transfers = 0
+        self.refused = 0
+        self.bytes = 0
+        self.held = 0.0
+        self.started = time.monotonic()
+
+    @classmethod
+    def priority(cls, job):
+        return job.get('priority', cls.catch_up)
+
+    def order(self, jobs):
+        """New episodes first, then show by show in episode order"""
+        shows = dict()
+        for job in jobs:
+            shows.setdefault(job['anime']['url'], len(shows))
+        return sorted(jobs, key=lambda job: (self.priority(job), shows[job['anime']['url']],
+                                             ep_sort_key(job['ep_num'])))
+
+    def queue(self, count=1):
+        with self.cond:
+            self.queued = self.queued + count
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def dequeue(self):
+        with self.cond:
+            self.queued = self.queued - 1
+
+    def admit(self, job):
+        """Start a transfer if the disk can take it, reserving its estimated size"""
+        size = job.get('estimated_bytes') or library_episode_size(self.config, job['anime']) or 0
+        free = shutil.disk_usage(existing_dir(self.config['base_directory'])).free
+        with self.cond:
+            if free - self.reserved - size < self.min_free:
+                self.refused = self.refused + 1
+                return False
+            self.reserved = self.reserved + size
+            job['reserved_bytes'] = size
+            priority = self.priority(job)
+            self.active[priority] = self.active.get(priority, 0) + 1
+            self.transfers = self.transfers + 1
+        return True
+
+    def done(self, job, nbytes):
+        with self.cond:
+            self.reserved = self.reserved - job.pop('reserved_bytes', 0)
+            priority = self.priority(job)
+            self.active[priority] = self.active.get(priority, 1) - 1
+            self.bytes = self.bytes + nbytes
+            self.cond.notify_all()
+
+    def set_elsewhere(self, busy):
+        with self.cond:
+            self.elsewhere = busy
+            self.cond.notify_all()
+
+    def limiters(self, job):
+        """Extra limiters for a transfer, catch-up ones give way to new episodes"""
+        if self.priority(job) == self.rss:
+            return []
+        return [PriorityGate(self)]
+
+    def wait_turn(self):
+        start = time.monotonic()
+        with self.cond:
+            while self.elsewhere or self.active.get(self.rss, 0) > 0:
+                self.cond.wait(1.0)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            with self.cond:
+                self.held = self.held + waited
+
+    def status(self):
+        """One line of queue depth and throughput so far"""
+        with self.cond:
+            took = time.monotonic() - self.started
+            active = sum(self.active.values())
+            return "[cyan]Queue: {} waiting, {} active, {:.1f} MB at {:.2f} MB/s".format(
+                self.queued, active, self.bytes / 1e6, self.bytes / 1e6 / max(took, 1e-6))
+
+    def summary(self):
+        """Print and report what the scheduler did over the run"""
+        took = time.monotonic() - self.started
+        throughput = self.bytes / max(took, 1e-6)
+        report.count('queue_depth_max', self.max_queued)
+        report.count('scheduler_bytes', self.bytes)
+        report.count('scheduler_held_ms', int(self.held * 1000))
+        report.count('scheduler_bytes_per_second', int(throughput))
+        print("[yellow]Scheduler: {} transfers, {:.1f} MB in {:.1f}s ({:.2f} MB/s), "
+              "peak queue {}, {:.1f}s held back for new episodes, {} refused for disk space".format(
+                  self.transfers, self.bytes / 1e6, took, throughput / 1e6, self.max_queued,
+                  self.held, self.refused))
+
+
+def download_stream(url, path, headers=None, limiters=(), chunk_size=1 << 16):
+    """Download to path.part, resuming it with a Range request, then rename into place"""
+    part = path + '.part'
+    # total size and validators of the stream the partial came from
+    meta_file = part + '.meta'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(part + '.json'):
+        # left by download_segmented, full size with holes, can't append to it
+        os.remove(part)
+        os.remove(part + '.json')
+
+    for _ in range(2):
+        have = 0
+        meta = dict()
+        if os.path.exists(part):
+            have = os.path.getsize(part)
+            try:
+                with open(meta_file, 'r') as stream:
+                    meta = json.load(stream)
+            except (OSError, ValueError):
+                meta = dict()
+        if have and not meta.get('total'):
+            # no record of what it belongs to, it can't be resumed safely
+            have = 0
+
+        req_headers = dict(headers or {})
+        if have:
+            req_headers['Range'] = 'bytes={}-'.format(have)
+            validator = meta.get('etag') or meta.get('modified')
+            if validator:
+                # a changed stream answers 200 with the whole new body
+                req_headers['If-Range'] = validator
+
+        with get_session().get(url, headers=req_headers, stream=True, timeout=60) as x:
+            if x.status_code == 416:
+                total = x.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                if have and total.isdigit() and int(total) == have == meta['total']:
+                    # nothing left to send, the partial is already complete
+                    total = have
+                    break
+                drop_partial(part)
+                continue
+            x.raise_for_status()
+            etag = x.headers.get('ETag')
+            if x.status_code == 206:
+                total = int(x.headers['Content-Range'].rsplit('/', 1)[1])
+                if total != meta['total'] or (etag and meta.get('etag') and etag != meta['etag']):
+                    # same range, different stream, splicing would corrupt it
+                    drop_partial(part)
+                    continue
+                mode = 'ab'
+            else:
+                # server ignored the range or the stream changed, start again
+                mode = 'wb'
+                have = 0
+                total = int(x.headers.get('Content-Length', 0)) or None
+                with atomic_write(meta_file) as stream:
+                    json.dump({'total': total, 'etag': etag,
+                               'modified': x.headers.get('Last-Modified')}, stream)
+            with open(part, mode) as stream:
+                for chunk in x.iter_content(chunk_size):
+                    for limiter in limiters:
+                        limiter.consume(len(chunk))
+                    stream.write(chunk)
+        break
+    else:
+        raise IncompleteDownload(0, None)
+
+    size = os.path.getsize(part)
+    if total is not None and size != total:
+        raise IncompleteDownload(size, total)
+    os.replace(part, path)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    return size - have
+
+
+def drop_partial(part):
+    """Remove a partial and its metadata"""
+    for name in (part, part + '.meta'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def probe_stream(url, headers=None):
+    """Return (size, accepts ranges) for a stream, size None if unknown"""
+    req_headers = dict(headers or {})
+    req_headers['Range'] = 'bytes=0-0'
+    with get_session().get(url, headers=req_headers, stream=True, timeout=60) as x:
+        x.raise_for_status()
+        if x.status_code == 206 and '/' in x.headers.get('Content-Range', ''):
+            total = x.headers['Content-Range'].rsplit('/', 1)[1]
+            if total.isdigit():
+                return int(total), True
+        length = x.headers.get('Content-Length')
+        return (int(length) if length else None), False
+
+
+def download_segmented(url, path, headers=None, segments=4, limiters=(),
+                       chunk_size=1 << 16):
+    """Download over several Range connections into path.part, resumable"""
+    size, ranged = probe_stream(url, headers)
+    if not ranged or not size or segments < 2:
+        return download_stream(url, path, headers=headers, limiters=limiters,
+                               chunk_size=chunk_size)
+
+    part = path + '.part'
+    progress_file = part + '.json'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # [start, end, done] per segment, kept next to the partial for resuming
+    progress = None
+    if os.path.exists(part) and os.path.exists(progress_file):
+        try:
+            with open(progress_file, 'r') as stream:
+                saved = json.load(stream)
+            if saved['size'] == size:
+                progress = saved['segments']
+        except (OSError, ValueError, KeyError):
+            progress = None
+    if progress is None:
+        # a single stream partial, or none, start over
+        drop_partial(part)
+        step = -(-size // segments)
+        progress = [[start, min(start + step, size) - 1, 0]
+                    for start in range(0, size, step)]
+        with open(part, 'wb') as stream:
+            stream.truncate(size)
+    already = sum(seg[2] for seg in progress)
+
+    lock = threading.Lock()
+
+    def save_progress():
+        with lock:
+            with atomic_write(progress_file) as stream:
+                json.dump({'size': size, 'segments': progress}, stream)
+
+    fd = os.open(part, os.O_WRONLY)
+
+    def fetch(seg):
+        start, end, done = seg
+        if start + done > end:
+            return
+        req_headers = dict(headers or {})
+        req_headers['Range'] = 'bytes={}-{}'.format(start + done, end)
+        try:
+            with get_session().get(url, headers=req_headers, stream=True, timeout=60) as x:
+                x.raise_for_status()
+                if x.status_code != 206:
+                    raise IncompleteDownload(start + done, end + 1)
+                for chunk in x.iter_content(chunk_size):
+                    chunk = chunk[:end + 1 - (start + seg[2])]
+                    for limiter in limiters:
+                        limiter.consume(len(chunk))
+                    os.pwrite(fd, chunk, start + seg[2])
+                    seg[2] += len(chunk)
+        finally:
+            save_progress()
+
+    try:
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            list(pool.map(fetch, progress))
+    finally:
+        os.close(fd)
+
+    got = sum(seg[2] for seg in progress)
+    if got != size:
+        raise IncompleteDownload(got, size)
+    os.replace(part, path)
+    os.remove(progress_file)
+    return got - already
+
+
+def staged_files(path):
+    """What the external downloader leaves in its staging directory for path"""
+    staged = os.path.dirname(path) + '/.partial/' + os.path.basename(path)
+    # aria2 keeps its resume state next to the file
+    return [staged, staged + '.aria2']
+
+
+def drop_staged(path):
+    """Remove the external downloader's leftovers once path was fetched otherwise"""
+    for name in staged_files(path):
+        if os.path.exists(name):
+            os.remove(name)
+    with contextlib.suppress(OSError):
+        os.rmdir(os.path.dirname(path) + '/.partial')
+
+
+def download_external(config, ep, path):
+    """Hand the episode to the configured external downloader, e.g. {aria2}"""
+    from anime_downloader.util import external_download
+    # the tool writes into a staging directory, renamed into place when it exits
+    staging = os.path.dirname(path) + '/.partial'
+    os.makedirs(staging, exist_ok=True)
+    file_format = os.path.basename(path)[:-len('.mp4')]
+    try:
+        external_download(config['external_downloader'], ep, file_format,
+                          config.get('speed_limit', 0) or 0, path=staging)
+    except SystemExit:
+        # external_download exits the process when the tool fails
+        raise IncompleteDownload(0, None)
+    except OSError as e:
+        # the tool isn't installed or can't be run, fall back to a single stream
+        print("[bold red]Can't run {}: {}".format(config['external_downloader'], str(e)))
+        raise IncompleteDownload(0, None)
+    staged = staging + '/' + file_format + '.mp4'
+    if not os.path.exists(staged):
+        raise IncompleteDownload(0, None)
+    size = os.path.getsize(staged)
+    os.replace(staged, path)
+    return size
+
+
+def configured_engine(config):
+    """The engine the config asks for, external when a tool is configured"""
+    engine = config.get('download_engine')
+    if engine is not None:
+        return engine
+    if config.get('external_downloader'):
+        return 'external'
+    return 'resume'
+
+
+def download_engine(config):
+    """Which engine to download with"""
+    engine = configured_engine(config)
+    if engine == 'external' and config.get('global_speed_limit'):
+        # the tool runs outside the shared token bucket
+        return 'resume'
+    return engine
+
+
+def check_engine(config):
+    """Warn when the configured engine can't be used as asked"""
+    if configured_engine(config) != download_engine(config):
+        print('[yellow]global_speed_limit is set, downloading with the resume engine '
+              'instead of the external downloader')
+
+
+def fetch_episode(config, ep, path, limiters=()):
+    """Download one episode with the configured engine, falling back if allowed"""
+    engine = download_engine(config)
+    if engine == 'plain':
+        ep.download(path=path)
+        return os.path.getsize(path)
+    limiters = speed_limiters(config) + list(limiters)
+    try:
+        if engine == 'external':
+            # the tool can't be held mid transfer, catch-up waits its turn up front
+            for limiter in limiters:
+                limiter.consume(0)
+            return download_external(config, ep, path)
+        source = ep.source()
+        if engine == 'segmented':
+            return download_segmented(source.stream_url, path, headers=source_headers(source),
+                                      segments=config.get('segments', 4), limiters=limiters)
+        return download_stream(source.stream_url, path, headers=source_headers(source),
+                               limiters=limiters)
+    except (IncompleteDownload, requests.ConnectionError,
+            requests.exceptions.ChunkedEncodingError) as e:
+        if engine == 'resume' or not config.get('download_fallback', True):
+            raise
+        print("[yellow]{} download failed ({}), retrying with a single stream".format(engine, str(e)))
+        report.count('engine_fallback')
+        source = ep.source()
+        nbytes = download_stream(source.stream_url, path, headers=source_headers(source),
+                                 limiters=limiters)
+        if engine == 'external':
+            drop_staged(path)
+        return nbytes
+
+
+def download_episode(config, job, host_limits, scheduler=None):
+    """Download one job, return its outcome"""
+    from anime_downloader.sites import exceptions as a_exceptions
+    AnimeRushEpisode = animerush_classes()[1]
+    anime = job['anime']
+    if scheduler is None:
+        scheduler = DownloadScheduler(config, [job])
+    scheduler.dequeue()
+    try:
+        adl = series_cache.resolve(config, anime)
+        if adl is None:
+            return 'not_found'
+        # the episode walks the qualities until one has a source
+        start = time.time()
+        ep = AnimeRushEpisode(job['link'], parent=adl, ep_no=job['ep_no'])
+        host = urlparse(ep.source().stream_url).netloc
+        tried = [adl.quality] + [q for q in adl._fallback_qualities if q != adl.quality]
+        job['quality'] = ep.quality
+        job['probes'] = tried.index(ep.quality) + 1 if ep.quality in tried else len(tried)
+        job['probe_seconds'] = time.time() - start
+        job['full_probe'] = adl.full_probe
+    except a_exceptions.NotFoundError:
+        print("[bold red]Episode {} of {} missing!".format(str(job['ep_num']),
+                                                           anime['full_name']))
+        return 'not_found'
+    except HostDown as e:
+        print("[bold red]Episode {} of {} skipped: {}".format(str(job['ep_num']),
+                                                              anime['full_name'], str(e)))
+        return 'host_down'
+    except requests.RequestException as e:
+        print("[bold red]Episode {} of {} unreachable: {}".format(str(job['ep_num']),
+                                                                  anime['full_name'], str(e)))
+        return 'http_error'
+
+    with host_limits.get(host):
+        if not scheduler.admit(job):
+            print("[bold red]Not enough free space for episode {} of {}, deferring".format(
+                str(job['ep_num']), anime['full_name']))
+            return 'no_space'
+        try:
+            return transfer_episode(config, job, ep, scheduler)
+        finally:
+            scheduler.done(job, job.get('nbytes', 0))
+
+
+def transfer_episode(config, job, ep, scheduler):
+    """Run an admitted transfer, return its outcome"""
+    from anime_downloader.sites import exceptions as a_exceptions
+    anime = job['anime']
+    print("[bold green]Downloading episode {} of {}".format(str(job['ep_num']),
+                                                            anime['full_name']))
+    try:
+        start = time.perf_counter()
+        nbytes = fetch_episode(config, ep, job['path'], scheduler.limiters(job))
+        job['nbytes'] = nbytes
+        took = time.perf_counter() - start
+        report.download(nbytes, took)
+        print("[green]Episode {} of {}: {:.1f} MB in {:.1f}s".format(
+            str(job['ep_num']), anime['full_name'], nbytes / 1e6, took))
+    except a_exceptions.NotFoundError:
+        print("[bold red]Episode Missing!")
+        return 'not_found'
+    except u_errors.HTTPError as e:
+        if e.code > 400:
+            print("[bold red]Download error! {}".format(str(e.code)))
+        return 'http_error'
+    except requests.HTTPError as e:
+        print("[bold red]Download error! {}".format(str(e.response.status_code)))
+        return 'http_error'
+    except HostDown as e:
+        print("[bold red]Download skipped: {}".format(str(e)))
+        return 'host_down'
+    except (IncompleteDownload, requests.ConnectionError,
+            requests.exceptions.ChunkedEncodingError) as e:
+        print("[bold red]Download interrupted, will resume: {}".format(str(e)))
+        return 'partial'
+    return 'downloaded'
+
+
+def episode_lease(job):
+    return 'episode:{}#{}'.format(job['anime']['url'], job['ep_num'])
+
+
+def claim_jobs(config, state, jobs):
+    """Keep the jobs no other worker holds a live lease on"""
+    ttl = config.get('lease_seconds', 900)
+    claimed = []
+    for job in jobs:
+        if state.claim(episode_lease(job), ttl):
+            claimed.append(job)
+            continue
+        print("[yellow]Episode {} of {} is being fetched by another worker".format(
+            str(job['ep_num']), job['anime']['full_name']))
+        report.count('lease_busy')
+    return claimed
+
+
+def run_downloads(config, jobs, index, state=None, progress=None):
+    """Download jobs on a bounded worker pool, return the grabbed count"""
+    if state is not None:
+        jobs = claim_jobs(config, state, jobs)
+    if not jobs:
+        return 0
+    workers = config.get('download_workers', 2)
+    host_limits = HostLimits(config.get('per_host_downloads', 2))
+    scheduler = DownloadScheduler(config, jobs)
+    jobs = scheduler.order(jobs)
+    ttl = config.get('lease_seconds', 900)
+    status_every = config.get('queue_status_seconds', 30)
+    # other workers' catch-up gives way while we fetch new episodes
+    new_episodes = any(scheduler.priority(job) == scheduler.rss for job in jobs)
+    backfill = not all(scheduler.priority(job) == scheduler.rss for job in jobs)
+    if state is not None and new_episodes:
+        state.claim('priority:' + state.owner, ttl)
+    renewed = shown = time.monotonic()
     grabbed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = dict()
+        # submitted in priority order, the pool starts them in that order
+        for job in jobs:
+            futures[pool.submit(download_episode, config, job, host_limits, scheduler)] = job
+        # bookkeeping stays on this thread, sqlite and the index are not shared
+        pending = set(futures)
+        while pending:
+            (finished, pending) = wait(pending, timeout=min(ttl / 3, 2),
+                                       return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            if state is not None:
+                # long downloads keep their leases
+                if now - renewed >= ttl / 3:
+                    state.renew(ttl)
+                    renewed = now
+                if backfill:
+                    scheduler.set_elsewhere(state.priority_holders() > 0)
+            if now - shown >= status_every:
+                print(scheduler.status())
+                shown = now
+            for future in finished:
+                job = futures[future]
+                try:
+                    status = future.result()
+                except Exception as e:
+                    # one broken episode must not cost the others their leases
+                    status = download_failed(job, e)
+                grabbed = grabbed + record_outcome(job, status, index, state)
+                if progress is not None:
+                    progress(job, status)
+
+    if state is not None and new_episodes:
+        state.release('priority:' + state.owner)
+    scheduler.summary()
+    download_summary(jobs)
+    return grabbed
+
+
+def download_failed(job, error):
+    """Report a worker that raised, the episode is retried like an http error"""
+    print("[bold red]Episode {} of {} failed: {!r}".format(
+        job['ep_num'], job['anime']['full_name'], error))
+    report.count('worker_errors')
+    return 'http_error'
+
+
+def record_outcome(job, status, index, state=None):
+    """Book a finished job, return 1 if it downloaded"""
+    report.count(status)
+    if state is not None:
+        state.release(episode_lease(job))
+    if 'quality' in job:
+        series_cache.qualities.update(job['anime']['url'], job['quality'],
+                                      job['full_probe'])
+        if state is not None:
+            state.record_quality(job['anime']['url'], job['quality'], job['probes'],
+                                 job['probe_seconds'], job['full_probe'])
+    if state is not None and 'guid' in job:
+        state.record(job['guid'], job['anime']['full_name'], job['ep_num'], status)
+    if status == 'downloaded':
+        index.add(os.path.dirname(job['path']), os.path.basename(job['path']))
+        return 1
+    return 0
+
+
+def download_summary(jobs):
+    """Print probe totals and the downloads left to resume"""
+    probed = [job for job in jobs if 'quality' in job]
+    report.count('quality_probes', sum(job['probes'] for job in probed))
+    report.count('quality_probe_ms', int(sum(job['probe_seconds'] for job in probed) * 1000))
+    if probed:
+        print("[yellow]Quality negotiation: {} episodes, {} probes, {:.1f}s".format(
+            len(probed), sum(job['probes'] for job in probed),
+            sum(job['probe_seconds'] for job in probed)))
+
+    partials = []
+    for job in jobs:
+        # a single stream partial, or one the external downloader left
+        for name in (job['path'] + '.part', staged_files(job['path'])[0]):
+            if os.path.exists(name):
+                partials.append(name)
+    if partials:
+        print("[yellow]{} partial downloads left to resume:".format(str(len(partials))))
+        for part in partials:
+            print("[yellow]  " + part)
+
+
+def fetch_feed(config, retries=0):
+    """Fetch the rss feed, conditionally unless earlier entries wait on a retry"""
+    rss = AnimeRushRSS(state_path(config, 'feed_state.json'),
+                       url=config.get('rss_url'))
+    # a 304 would leave pending retries until the feed next changes
+    conditional = not retries
+    if retries:
+        report.count('feed_retry_poll')
+    with report.phase('load_rss'):
+        rss.load_rss(conditional)
+    return rss
+
+
+def record_feed_poll(rss, state):
+    """Book a feed poll, return True if there is something to parse"""
+    state.record_poll(rss.changed)
+    report.count('feed_changed' if rss.changed else 'feed_unchanged')
+    print(rss.poll_summary())
+    return rss.changed
+
+
+def parse_rss(config, registry, index, state):
+    """Parse the rss feed, download files"""
+    rss = fetch_feed(config, state.pending_retries(config.get('retry_days', 7)))
+    if not record_feed_poll(rss, state):
+        return 0
+    jobs = list(rss_jobs(config, registry, index, state, rss))
+
+    # each show is scraped once, however many of its episodes are missing
+    shows = dict()
+    for job in jobs:
+        shows[job['anime']['url']] = job['anime']
+    series_cache.prefetch(config, shows.values())
+
+    grabbed = run_downloads(config, jobs, index, state)
+    rss.mark_read(state)
+    return grabbed
+
+
+def rss_jobs(config, registry, index, state, rss):
+    """Yield a download job for each new feed entry we are missing"""
     # setup_logger('DEBUG')
-    for e in entries:
-        show = rss.show_name(e)
-        ep_num = rss.ep_num(e)
-        orig_num = rss.ep_num(e)
-        monitored = is_monitored(config, show)
-        if not monitored:
+    for e in rss.get_entries():
+        job = feed_job(config, registry, state, rss, e)
+        if job is None:
             continue
-        anime = find_anime_in_monitored_list(show, config['monitored'])
+        if episode_present(config, job, index):
+            state.record(job['guid'], job['show'], job['ep_num'], 'present')
+            continue
+        print("Episode {} of {} missing, downloading".format(str(job['ep_num']), job['show']))
+        yield job
 
-        # don't break specials
-        if ep_num.isdigit():
-            ep_num = int(ep_num) + anime['season_offset']
-        else:
-            part = ep_num.split('.')
-            ep_num = str(int(part[0]) + anime['season_offset']) + '.' + part[1]
-            
-        basedir = config['base_directory'] + '/' + gen_basedir(anime)
-        create_tree(config, anime)
-        if not have_episode(anime, ep_num, basedir):
-            print("Episode {} of {} missing, downloading".format(str(ep_num), show))
-            try:
-                adl = AnimeRush(anime['url'], quality=config['quality'],
-                                fallback_qualities=config['fallback_qualities'])
-                adl_e = AnimeRushEpisode(e.link, parent=adl, ep_no=orig_num)
-            except IndexError:
+
+def feed_job(config, registry, state, rss, e):
+    """The download job for a feed entry still to be handled, None if the
+    entry is settled or its show unmonitored"""
+    guid = rss.guid(e)
+    if not state.needs_processing(guid):
+        return None
+    show = rss.show_name(e)
+    ep_num = rss.ep_num(e)
+    orig_num = rss.ep_num(e)
+    anime = registry.find(show)
+    if anime is None or not anime['monitored']:
+        state.record(guid, show, orig_num, 'not_monitored')
+        return None
+
+    # don't break specials
+    if ep_num.isdigit():
+        ep_num = int(ep_num) + anime['season_offset']
+    else:
+        part = ep_num.split('.')
+        ep_num = str(int(part[0]) + anime['season_offset']) + '.' + part[1]
+
+    job = dict()
+    job['anime'] = anime
+    job['show'] = show
+    job['ep_num'] = ep_num
+    job['ep_no'] = orig_num
+    job['link'] = e.link
+    job['guid'] = guid
+    job['path'] = gen_fullname(anime, config['base_directory'], ep_num)
+    job['priority'] = DownloadScheduler.rss
+    return job
+
+
+def episode_present(config, job, index):
+    """Make the show's directories and look for the episode in them"""
+    anime = job['anime']
+    basedir = config['base_directory'] + '/' + gen_basedir(anime)
+    create_tree(config, anime)
+    with report.phase('have_episode'):
+        return have_episode(anime, job['ep_num'], basedir, index)
+
+
+def run_pipeline(config, registry, index, state):
+    """Default run as an asyncio pipeline, return (grabbed, have_new)"""
+    import asyncio
+    with report.phase('pipeline'):
+        return asyncio.run(pipeline(config, registry, index, state))
+
+
+async def pipeline(config, registry, index, state):
+    """Feed and homepage fetched together, each show resolved as soon as the
+    feed names it, then downloads over a bounded queue in scheduler order"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    workers = config.get('download_workers', 2)
+    resolvers = config.get('resolve_workers', 4)
+    depth = config.get('pipeline_depth', workers * 2)
+    host_limits = HostLimits(config.get('per_host_downloads', 2))
+    scheduler = DownloadScheduler(config)
+    # blocking work runs here, sqlite and the index stay on the loop thread
+    pool = ThreadPoolExecutor(max_workers=workers + resolvers + 2)
+    resolving = asyncio.Semaphore(resolvers)
+    download_q = asyncio.Queue(maxsize=depth)
+    shows = dict()
+    jobs = []
+    grabbed = 0
+
+    async def resolve(anime):
+        async with resolving:
+            await loop.run_in_executor(pool, series_cache.warm, config, anime)
+
+    async def read_feed(rss):
+        # the feed is read and the disk checked on the pool, sqlite stays here
+        entries = rss.get_entries()
+        while True:
+            e = await loop.run_in_executor(pool, next, entries, None)
+            if e is None:
+                break
+            job = feed_job(config, registry, state, rss, e)
+            if job is None:
                 continue
+            if await loop.run_in_executor(pool, episode_present, config, job, index):
+                state.record(job['guid'], job['show'], job['ep_num'], 'present')
+                continue
+            print("Episode {} of {} missing, downloading".format(str(job['ep_num']), job['show']))
+            if not claim_jobs(config, state, [job]):
+                continue
+            jobs.append(job)
+            scheduler.queue()
+            url = job['anime']['url']
+            if url not in shows:
+                shows[url] = asyncio.ensure_future(resolve(job['anime']))
+
+    async def produce(rss):
+        try:
+            await read_feed(rss)
+        except requests.RequestException as e:
+            # cut off mid stream, the entries read so far are still fetched
+            # and the feed is read again from the old stop point next time
+            print('[bold red]Feed read failed: {}'.format(str(e)))
+            report.count('feed_read_errors')
+        finally:
+            # the feed is newest first, a show's lower episodes go first
+            for job in scheduler.order(jobs):
+                await shows[job['anime']['url']]
+                # blocks while the downloads are behind
+                await download_q.put(job)
+            for _ in range(workers):
+                await download_q.put(None)
+
+    async def download():
+        nonlocal grabbed
+        while True:
+            job = await download_q.get()
+            if job is None:
+                return
             try:
-                adl_e.download(path=gen_fullname(anime, config['base_directory'],
-                                                 ep_num))
-                grabbed = grabbed + 1
-            except a_exceptions.NotFoundError:
-                print("[bold red]Episode Missing!")
-            except u_errors.HTTPError as e:
-                if e.code > 400:
-                    print("[bold red]Download error! {}".format(str(e.code)))
-
-            # util.external_download(external_downloader, episode,
-            #                        file_format, speed_limit, path=download_dir)
+                status = await loop.run_in_executor(pool, download_episode,
+                                                    config, job, host_limits, scheduler)
+            except Exception as e:
+                status = download_failed(job, e)
+            grabbed = grabbed + record_outcome(job, status, index, state)
+
+    async def heartbeat():
+        ttl = config.get('lease_seconds', 900)
+        while True:
+            await asyncio.sleep(ttl / 3)
+            state.renew(ttl)
 
-    return grabbed
+    try:
+        ongoing = loop.run_in_executor(pool, get_ongoing, config)
+        rss = await loop.run_in_executor(pool, fetch_feed, config,
+                                         state.pending_retries(config.get('retry_days', 7)))
+        if record_feed_poll(rss, state):
+            state.claim('priority:' + state.owner, config.get('lease_seconds', 900))
+            beat = asyncio.ensure_future(heartbeat())
+            downloads = [asyncio.ensure_future(download()) for _ in range(workers)]
+            try:
+                await produce(rss)
+            finally:
+                # produce always queues the stop markers, so this drains the queue
+                # and books every transfer before the pool shuts down
+                await asyncio.gather(*downloads)
+                beat.cancel()
+                state.release('priority:' + state.owner)
+            if jobs:
+                scheduler.summary()
+            download_summary(jobs)
+            rss.mark_read(state)
+        # the downloads are done, a homepage failure must not lose their count
+        try:
+            have_new = new_anime_check(config, registry, await ongoing)
+        except requests.RequestException as e:
+            print('[bold red]New anime check failed: {}'.format(str(e)))
+            have_new = False
+    finally:
+        pool.shutdown(wait=True)
+    return (grabbed, have_new)
 
 
-def catch_up_all_anime(config, ask):
-    """Catch up missing anime"""
+def missing_episode_jobs(config, anime, index, ask):
+    """Find the missing episodes of one anime, confirming each if asked"""
     q_download = [
         {
             'type': 'confirm',
@@ -443,55 +2630,127 @@ def catch_up_all_anime(config, ask):
             'default': False,
         }
     ]
-    for anime in config['monitored']:
-        if not anime['monitored']:
+    print("[yellow]Looking for missing episodes of " + anime['full_name'])
+    basedir = config['base_directory'] + '/' + gen_basedir(anime)
+    try:
+        adl = series_cache.resolve(config, anime)
+    except requests.RequestException as e:
+        print("[bold red]Can't reach {}: {}".format(anime['full_name'], str(e)))
+        return []
+    if adl is None:
+        return []
+
+    jobs = []
+    # episodes are only built (and their sources negotiated) for missing ones,
+    # iterating the series would build every one of them
+    for (ep_no, link) in adl._episode_urls:
+        ep_num = int(ep_no) + anime['season_offset']
+        with report.phase('have_episode'):
+            present = have_episode(anime, ep_num, basedir, index)
+        if present:
             continue
-        print("[yellow]Looking for missing episodes of " + anime['full_name'])
-        basedir = config['base_directory'] + '/' + gen_basedir(anime)
-        try:
-            adl = AnimeRush(anime['url'], quality=config['quality'],
-                            fallback_qualities=config['fallback_qualities'])
-        except IndexError:
-            adl = []
-        for ep in adl:
-            ep_num = int(ep.ep_no) + anime['season_offset']
-            if have_episode(anime, ep_num, basedir):
+        print("[red]Missing Episode {} of {}".format(str(ep_num),
+                                                     anime['full_name']))
+        # ask everything before the pool starts, so prompts don't stall it
+        if ask:
+            from PyInquirer import prompt
+            answer = prompt(q_download)
+            if not answer['doit']:
                 continue
-            print("[red]Missing Episode {} of {}".format(str(ep_num),
-                                                         anime['full_name']))
-            fullpath = gen_fullname(anime, config['base_directory'], ep_num)
-
-            if ask:
-                answer = prompt(q_download)
-                if answer['doit']:
-                    print("[bold green]Downloading episode {} of {}".format(str(ep_num), anime['full_name']))
-                    try:
-                        ep.download(path=fullpath)
-                    except a_exceptions.NotFoundError:
-                        print("[bold red]Episode Missing!")
-                    except u_errors.HTTPError as e:
-                        if e.code > 400:
-                            print("[bold red]Download error! {}".format(str(e.code)))
-            else:
-                print("[bold green]Downloading episode {} of {}".format(str(ep_num), anime['full_name']))
-                try:
-                    ep.download(path=fullpath)
-                except a_exceptions.NotFoundError:
-                    print("[bold red]Episode Missing!")
-                except u_errors.HTTPError as e:
-                    if e.code > 400:
-                        print("[bold red]Download error! {}".format(str(e.code)))
+        job = dict()
+        job['anime'] = anime
+        job['ep_num'] = ep_num
+        job['ep_no'] = ep_no
+        job['link'] = link
+        job['path'] = gen_fullname(anime, config['base_directory'], ep_num)
+        jobs.append(job)
+    return jobs
+
+
+def shard_of(anime, shards):
+    """Stable shard number, 1 based, for a show"""
+    digest = hashlib.sha1(anime['url'].encode()).hexdigest()
+    return int(digest, 16) % shards + 1
+
+
+class ShardProgress:
+    """Shows and episodes done in one catch-up shard, kept in the state db"""
+
+    def __init__(self, state, shard):
+        self.state = state
+        self.label = '{}/{}'.format(*shard) if shard else 'all'
+        self.shows = 0
+        self.shows_done = 0
+        self.episodes = 0
+        self.episodes_done = 0
+        self.left = dict()
+
+    def save(self):
+        self.state.record_shard(self.label, self.shows, self.shows_done,
+                                self.episodes, self.episodes_done)
+
+    def scanned(self, anime, jobs):
+        self.episodes = self.episodes + len(jobs)
+        if jobs:
+            self.left[anime['url']] = len(jobs)
+        else:
+            self.shows_done = self.shows_done + 1
+        self.save()
+
+    def finished(self, job, status):
+        self.episodes_done = self.episodes_done + 1
+        url = job['anime']['url']
+        self.left[url] = self.left.get(url, 1) - 1
+        if self.left[url] == 0:
+            self.shows_done = self.shows_done + 1
+            print("[cyan]Shard {}: {} of {} shows, {} of {} episodes".format(
+                self.label, self.shows_done, self.shows, self.episodes_done, self.episodes))
+        self.save()
+
+
+def catch_up_all_anime(config, registry, index, state, ask, shard=None):
+    """Catch up missing anime, or the shard (number, count) of them"""
+    animes = list(registry.monitored())
+    if shard is not None:
+        animes = [anime for anime in animes if shard_of(anime, shard[1]) == shard[0]]
+    progress = ShardProgress(state, shard)
+    ttl = config.get('lease_seconds', 900)
+
+    # a show is scanned by one worker at a time
+    claimed = []
+    for anime in animes:
+        if state.claim('show:' + anime['url'], ttl):
+            claimed.append(anime)
+        else:
+            print("[yellow]{} is being caught up by another worker".format(anime['full_name']))
+            report.count('lease_busy')
+    if not claimed:
+        print("[green]Shard {}: nothing left to claim".format(progress.label))
+        return
+    progress.shows = len(claimed)
+    progress.save()
+    if config.get('prefetch_series', True):
+        series_cache.prefetch(config, claimed)
+
+    jobs = []
+    for anime in claimed:
+        state.renew(ttl)
+        show_jobs = missing_episode_jobs(config, anime, index, ask)
+        progress.scanned(anime, show_jobs)
+        jobs.extend(show_jobs)
+    try:
+        grabbed = run_downloads(config, jobs, index, state, progress.finished)
+    finally:
+        state.release_all()
+    print("[green]Shard {}: grabbed {} of {} missing episodes".format(
+        progress.label, str(grabbed), str(len(jobs))))
 
 
-def catch_up_single_anime(config, ask):
+def catch_up_single_anime(config, registry, index, state, ask):
     """Catch up on a single anime"""
 
     # make a list
-    alist = []
-    for anime in config['monitored']:
-        if not anime['monitored']:
-            continue
-        alist.append(anime['full_name'])
+    alist = [anime['full_name'] for anime in registry.monitored()]
 
     q_which = [
         {
@@ -501,60 +2760,282 @@ def catch_up_single_anime(config, ask):
             'choices': alist,
         }
     ]
-
-    q_download = [
-        {
-            'type': 'confirm',
-            'name': 'doit',
-            'message': 'Download this episode?',
-            'default': False,
-        }
-    ]
+    from PyInquirer import prompt
     a_which = prompt(q_which)
-    anime = find_anime_in_monitored_list(a_which['selected'], config['monitored'])
-    print("[yellow]Looking for missing episodes of " + anime['full_name'])
-    basedir = config['base_directory'] + '/' + gen_basedir(anime)
+    anime = registry.find(a_which['selected'])
+    jobs = missing_episode_jobs(config, anime, index, ask)
+    grabbed = run_downloads(config, jobs, index, state)
+    print("[green]Grabbed {} of {} missing episodes".format(str(grabbed), str(len(jobs))))
+
+
+def library_episode_size(config, anime):
+    """Mean size of a show's episodes already on disk, None if there are none"""
+    sdir = config['base_directory'] + '/' + gen_basedir(anime) + '/' + gen_seasondir(anime)
+    sizes = []
     try:
-        adl = AnimeRush(anime['url'], quality=config['quality'],
-                        fallback_qualities=config['fallback_qualities'])
-    except IndexError:
-            adl = []
-
-    for ep in adl:
-        ep_num = int(ep.ep_no) + anime['season_offset']
-        if have_episode(anime, ep_num, basedir):
+        with os.scandir(sdir) as it:
+            for entry in it:
+                if entry.name.endswith('.mp4') and entry.is_file():
+                    sizes.append(entry.stat().st_size)
+    except FileNotFoundError:
+        return None
+    if not sizes:
+        return None
+    return sum(sizes) // len(sizes)
+
+
+def probe_episode_size(config, job):
+    """Size of one episode's stream, None if it can't be found"""
+    from anime_downloader.sites import exceptions as a_exceptions
+    AnimeRushEpisode = animerush_classes()[1]
+    adl = series_cache.resolve(config, job['anime'])
+    if adl is None:
+        return None
+    try:
+        ep = AnimeRushEpisode(job['link'], parent=adl, ep_no=job['ep_no'])
+        source = ep.source()
+        return probe_stream(source.stream_url, source_headers(source))[0]
+    except (a_exceptions.NotFoundError, requests.RequestException):
+        return None
+
+
+def build_plan(config, registry, index, shard=None):
+    """Resolve every monitored show at once and list the episodes missing on disk"""
+    animes = list(registry.monitored())
+    if shard is not None:
+        animes = [anime for anime in animes if shard_of(anime, shard[1]) == shard[0]]
+    with report.phase('plan_resolve'):
+        series_cache.prefetch(config, animes)
+
+    missing = []
+    for anime in animes:
+        jobs = missing_episode_jobs(config, anime, index, False)
+        if jobs:
+            missing.append((anime, jobs))
+
+    # one estimate per show, from the library or else one probed episode
+    def estimate(item):
+        (anime, jobs) = item
+        size = library_episode_size(config, anime)
+        if size is None:
+            size = probe_episode_size(config, jobs[0])
+        return size
+
+    with report.phase('plan_estimate'):
+        with ThreadPoolExecutor(max_workers=config.get('resolve_workers', 4)) as pool:
+            sizes = list(pool.map(estimate, missing))
+
+    episodes = []
+    for ((anime, jobs), size) in zip(missing, sizes):
+        for job in jobs:
+            episodes.append({'show': anime['full_name'], 'url': anime['url'],
+                             'ep_num': job['ep_num'], 'ep_no': job['ep_no'],
+                             'link': job['link'], 'path': job['path'],
+                             'estimated_bytes': size})
+    return {'created': time.time(),
+            'shard': '{}/{}'.format(*shard) if shard else None,
+            'shows': len(animes),
+            'episodes': episodes,
+            'estimated_bytes': sum(e['estimated_bytes'] or 0 for e in episodes)}
+
+
+def write_plan(plan, plan_file):
+    with atomic_write(plan_file) as stream:
+        json.dump(plan, stream, indent=1)
+
+
+def print_plan(plan):
+    """Per show episode counts and estimated sizes"""
+    shows = dict()
+    for e in plan['episodes']:
+        (count, size) = shows.get(e['show'], (0, 0))
+        shows[e['show']] = (count + 1, size + (e['estimated_bytes'] or 0))
+    for show in sorted(shows):
+        (count, size) = shows[show]
+        print('  {:<50} {:>4} episodes  ~{:.0f} MB'.format(show, count, size / 1e6))
+    print("[yellow]{} episodes of {} shows missing, ~{:.1f} GB".format(
+        len(plan['episodes']), len(shows), plan['estimated_bytes'] / 1e9))
+
+
+def execute_plan(config, registry, index, state, plan_file):
+    """Download the episodes of a saved plan that are still missing"""
+    with open(plan_file, 'r') as stream:
+        plan = json.load(stream)
+    jobs = []
+    for e in plan['episodes']:
+        anime = registry.find(e['show'])
+        if anime is None or not anime['monitored'] or anime['url'] != e['url']:
+            print("[yellow]{} is no longer monitored, skipping".format(e['show']))
             continue
-        print("[red]Missing Episode {} of {}".format(str(ep_num),
-                                                     anime['full_name']))
-        fullpath = gen_fullname(anime, config['base_directory'], ep_num)
-        fullsdir = basedir + '/' + gen_seasondir(anime) + '/'
+        basedir = config['base_directory'] + '/' + gen_basedir(anime)
+        if have_episode(anime, e['ep_num'], basedir, index):
+            continue
+        job = dict()
+        job['anime'] = anime
+        job['ep_num'] = e['ep_num']
+        job['ep_no'] = e['ep_no']
+        job['link'] = e['link']
+        job['path'] = gen_fullname(anime, config['base_directory'], e['ep_num'])
+        job['estimated_bytes'] = e['estimated_bytes']
+        jobs.append(job)
+    grabbed = run_downloads(config, jobs, index, state)
+    print("[green]Grabbed {} of {} planned episodes".format(str(grabbed), str(len(jobs))))
+    return grabbed
 
-        if ask:
-            answer = prompt(q_download)
-            if answer['doit']:
-                print("[bold green]Downloading episode {} of {}".format(str(ep_num), anime['full_name']))
-                # external_download('{aria2}',
-                #                   ep,
-                #                   gen_epname(anime, ep.ep_no),
-                #                   0,
-                #                   path=fullsdir)
-                try:
-                    ep.download(path=fullpath)
-                except a_exceptions.NotFoundError:
-                    print("[bold red]Episode Missing!")
-                except u_errors.HTTPError as e:
-                    if e.code > 400:
-                        print("[bold red]Download error! {}".format(str(e.code)))
 
-        else:
-            print("[bold green]Downloading episode {} of {}".format(str(ep_num), anime['full_name']))
-            try:
-                ep.download(path=fullpath)
-            except a_exceptions.NotFoundError:
-                print("[bold red]Episode Missing!")
-            except u_errors.HTTPError as e:
-                if e.code > 400:
-                    print("[bold red]Download error! {}".format(str(e.code)))
+class PollScheduler:
+    """Poll often around the hours the feed usually changes, back off otherwise"""
+    week = 7 * 24
+
+    def __init__(self, state, min_interval=300, max_interval=3600, history_days=28):
+        self.state = state
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.history_days = history_days
+
+    @staticmethod
+    def hour_of_week(ts):
+        t = time.localtime(ts)
+        return t.tm_wday * 24 + t.tm_hour
+
+    def hot_hours(self):
+        """Hours of the week in which the feed has changed before"""
+        since = time.time() - self.history_days * 86400
+        return set(self.hour_of_week(ts) for ts in self.state.feed_changes(since))
+
+    def next_interval(self):
+        """Seconds until the next poll"""
+        now = time.time()
+        hot = self.hot_hours()
+        hour = self.hour_of_week(now)
+        # the hour a release usually lands in, and the ones either side
+        if hot & {(hour - 1) % self.week, hour, (hour + 1) % self.week}:
+            return self.min_interval
+
+        idle = self.state.unchanged_streak()
+        interval = min(self.min_interval * (2 ** min(idle, 16)), self.max_interval)
+
+        # don't sleep through the start of the next busy hour
+        for ahead in range(2, self.week):
+            if (hour + ahead) % self.week in hot:
+                start = now - (now % 3600) + (ahead - 1) * 3600
+                interval = min(interval, max(start - now, self.min_interval))
+                break
+        return interval
+
+
+def load_daemon_config(conf_f):
+    """Parse and fix the config file, None if it can't be used as it is"""
+    try:
+        config = parse_config(conf_f)
+        if not isinstance(config, dict) or 'monitored' not in config:
+            print('[bold red]No usable monitored list in ' + conf_f)
+            return None
+        return fix_config(config, conf_f)
+    except OSError as e:
+        print('[bold red]Could not read {}: {}'.format(conf_f, e))
+        return None
+
+
+def run_daemon(conf_f):
+    """Keep polling the feed until SIGTERM, reloading the config on change"""
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        print('[yellow]Signal {} received, stopping after this poll'.format(signum))
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    config = None
+    conf_mtime = None
+    last_new_check = 0
+    while not stop.is_set():
+        try:
+            mtime = os.stat(conf_f).st_mtime_ns
+        except FileNotFoundError:
+            # an editor saving by rename, look again next poll
+            mtime = conf_mtime
+        new_config = None
+        if mtime != conf_mtime:
+            conf_mtime = mtime
+            new_config = load_daemon_config(conf_f)
+            if new_config is None and config is None:
+                return
+            if new_config is None:
+                print('[bold red]Config file not loaded, keeping the previous one')
+        if new_config is not None:
+            if config is not None:
+                print('[green]Config file changed, reloading')
+                index.save()
+                state.close()
+                series_cache.clear()
+            config = new_config
+            with contextlib.suppress(FileNotFoundError):
+                # fix_config may have rewritten it
+                conf_mtime = os.stat(conf_f).st_mtime_ns
+            registry = MonitoredRegistry(config['monitored'])
+            install_session(config)
+            check_engine(config)
+            index = EpisodeIndex(state_path(config, 'episode_index.json'))
+            state = StateStore(state_path(config, 'state.db'),
+                               retry_limit=config.get('retry_limit', 10))
+            series_cache.qualities = QualityCache(state, config.get('quality_reprobe_days', 7))
+            scheduler = PollScheduler(state,
+                                      min_interval=config.get('poll_min_interval', 300),
+                                      max_interval=config.get('poll_max_interval', 3600))
+
+        report.reset('daemon')
+        try:
+            grabbed = parse_rss(config, registry, index, state)
+            if grabbed > 0:
+                print("[green]Grabed {} new episodes".format(str(grabbed)))
+            if time.time() - last_new_check > config.get('new_anime_interval', 21600):
+                last_new_check = time.time()
+                if new_anime_check(config, registry):
+                    print('There is new anime to monitor')
+                    print('Run with the -p option to update conf file')
+        except (requests.RequestException, sqlite3.OperationalError) as e:
+            # network trouble or another process holding the database
+            print('[bold red]Poll failed: {}'.format(str(e)))
+        index.save()
+        write_report(config)
+        # the directory index is only trusted once per poll
+        index.checked.clear()
+
+        interval = scheduler.next_interval()
+        print('[yellow]Next poll in {} seconds'.format(int(interval)))
+        stop.wait(interval)
+
+    index.save()
+    state.close()
+
+
+def show_stats(state):
+    """Print what the state database knows about past runs"""
+    by_status, per_day = state.stats()
+    print('[yellow]RSS entries by outcome')
+    for status in sorted(by_status):
+        print('  {:<14} {}'.format(status, by_status[status]))
+    print('[yellow]Episodes downloaded per day')
+    for day, count in per_day:
+        print('  {}   {}'.format(day, count))
+    episodes, probes, seconds = state.probe_stats()
+    print('[yellow]Quality negotiation')
+    print('  {} episodes, {} qualities probed, {:.1f}s spent'.format(episodes, probes, seconds))
+    shards = state.shard_progress()
+    if shards:
+        print('[yellow]Catch-up shards')
+        for (shard, owner, shows, shows_done, episodes, episodes_done, updated) in shards:
+            print('  {:<6} {}/{} shows  {}/{} episodes  {}  {}'.format(
+                shard, shows_done, shows, episodes_done, episodes, owner,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(updated))))
+    leases = state.live_leases()
+    if leases:
+        print('[yellow]Live leases')
+        for owner in sorted(leases):
+            print('  {:<30} {}'.format(owner, leases[owner]))
 
 
 def main():
@@ -567,9 +3048,23 @@ def main():
 
     if not args.pick_anime:
         config = fix_config(config, args.conffile)
+        registry = MonitoredRegistry(config['monitored'])
+        install_session(config)
+        check_engine(config)
+
+    if args.shard is not None and not args.initial_download_all and args.plan is None:
+        print('[red]--shard only applies to -i and --plan')
+        exit(1)
+
+    if args.batch and not args.pick_anime:
+        print('[red]--batch only applies to -p')
+        exit(1)
 
     if args.new_anime_check:
-        have_new = new_anime_check(config)
+        report.reset('new_anime_check')
+        have_new = new_anime_check(config, registry)
+        report.count('new_anime', int(have_new))
+        write_report(config)
         if have_new:
             print('There is new anime to monitor')
             print('Run with the -p option to update conf file')
@@ -577,31 +3072,97 @@ def main():
         exit(1)
 
     if args.pick_anime:
-        config = pick_anime(config, args.directory)
-        with open(args.conffile, 'w') as file:
-            yaml.dump(config, file)
+        report.reset('pick')
+        try:
+            config = pick_anime(config, args.directory, args.batch)
+        except ValueError as e:
+            print('[red]' + str(e))
+            exit(1)
+        save_config(config, args.conffile)
         print('[green]Created/updated config file ' + args.conffile)
+        write_report(config)
+        exit(0)
+
+    if args.daemon:
+        run_daemon(args.conffile)
+        exit(0)
+
+    index = EpisodeIndex(state_path(config, 'episode_index.json'))
+    state = StateStore(state_path(config, 'state.db'),
+                       retry_limit=config.get('retry_limit', 10))
+    series_cache.qualities = QualityCache(state, config.get('quality_reprobe_days', 7))
+
+    if args.plan is not None:
+        report.reset('plan')
+        plan_file = args.plan or state_path(config, 'plan.json')
+        plan = build_plan(config, registry, index, args.shard)
+        write_plan(plan, plan_file)
+        print_plan(plan)
+        print('[green]Wrote plan to ' + plan_file)
+        index.save()
+        state.close()
+        write_report(config)
+        exit(0)
+
+    if args.run_plan is not None:
+        report.reset('run_plan')
+        execute_plan(config, registry, index, state,
+                     args.run_plan or state_path(config, 'plan.json'))
+        index.save()
+        state.close()
+        write_report(config)
         exit(0)
 
     if args.initial_download_all:
-        catch_up_all_anime(config, args.ask_initial)
+        report.reset('catch_up_all')
+        catch_up_all_anime(config, registry, index, state, args.ask_initial, args.shard)
+        index.save()
+        state.close()
+        write_report(config)
         exit(0)
 
     if args.single_initial_download:
-        catch_up_single_anime(config, args.ask_initial)
+        report.reset('catch_up_single')
+        catch_up_single_anime(config, registry, index, state, args.ask_initial)
+        index.save()
+        state.close()
+        write_report(config)
+        exit(0)
+
+    if args.stats:
+        show_stats(state)
+        state.close()
         exit(0)
 
     # fall down to default operation
     # get RSS, check monitored anime, and download.
-    grabbed = parse_rss(config)
+    report.reset('rss')
+    have_new = None
+    try:
+        if args.pipeline or config.get('pipeline', False):
+            (grabbed, have_new) = run_pipeline(config, registry, index, state)
+        else:
+            grabbed = parse_rss(config, registry, index, state)
+    except requests.RequestException as e:
+        print('[bold red]Feed fetch failed: {}'.format(str(e)))
+        grabbed = 0
+    index.save()
+    state.close()
     if grabbed > 0:
         print("[green]Grabed {} new episodes".format(str(grabbed)))
     else:
         print("[bold green]No new episodes of monitored anime to download")
-    have_new = new_anime_check(config)
+    if have_new is None:
+        try:
+            have_new = new_anime_check(config, registry)
+        except requests.RequestException as e:
+            print('[bold red]New anime check failed: {}'.format(str(e)))
+            have_new = False
     if have_new:
         print('There is new anime to monitor')
         print('Run with the -p option to update conf file')
+    report.count('new_anime', int(have_new))
+    write_report(config)
 
 if __name__ == '__main__':
     main()
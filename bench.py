@@ -0,0 +1,862 @@
+"""
+Micro benchmarks for anime_list.py
+"""
+
+import os
+import re
+import glob
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import timeit
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from bs4 import BeautifulSoup
+
+import anime_list
+
+
+def make_monitored(count, monitored_every=10):
+    """Build a fake config['monitored'] list, mostly unmonitored shows"""
+    mlist = []
+    for i in range(count):
+        entry = dict()
+        entry['full_name'] = 'Show Number {} Season 2'.format(i)
+        entry['monitored'] = (i % monitored_every) == 0
+        if entry['monitored']:
+            entry['name'] = 'Show Number {}'.format(i)
+            entry['season'] = 2
+            entry['season_offset'] = 0
+            entry['url'] = 'https://www.animerush.tv/anime/show-{}/'.format(i)
+        mlist.append(entry)
+    return mlist
+
+
+def linear_find(anime_name, mlist):
+    """The old find_anime_in_monitored_list scan, for comparison"""
+    for a in mlist:
+        if a['full_name'] == anime_name:
+            return a
+    return None
+
+
+def bench_registry(args):
+    """Lookup cost against config size, linear scan vs registry"""
+    print('{:>8} {:>14} {:>14} {:>12}'.format('shows', 'linear us/op',
+                                               'registry us/op', 'build ms'))
+    for size in args.sizes:
+        mlist = make_monitored(size)
+        # a feed-sized batch of lookups spread over the list, plus misses
+        names = [mlist[i]['full_name'] for i in range(0, size, max(1, size // 50))]
+        names += ['Not A Show {}'.format(i) for i in range(10)]
+
+        build = timeit.timeit(lambda: anime_list.MonitoredRegistry(mlist),
+                              number=args.repeat) / args.repeat
+        registry = anime_list.MonitoredRegistry(mlist)
+
+        def run_linear():
+            for n in names:
+                linear_find(n, mlist)
+
+        def run_registry():
+            for n in names:
+                registry.find(n)
+
+        t_lin = timeit.timeit(run_linear, number=args.repeat) / args.repeat
+        t_reg = timeit.timeit(run_registry, number=args.repeat) / args.repeat
+        print('{:>8} {:>14.2f} {:>14.2f} {:>12.2f}'.format(
+            size,
+            t_lin / len(names) * 1e6,
+            t_reg / len(names) * 1e6,
+            build * 1e3))
+
+
+sample_titles = [
+    'Boruto: Naruto Next Generations',
+    'Shingeki no Kyojin: The Final Season',
+    'Kaguya-sama wa Kokurasetai 3rd Season',
+    'Youkoso Jitsuryoku Shijou Shugi no Kyoushitsu e 2nd Season',
+    'Overlord IV',
+    'Mob Psycho 100 S3',
+    'Made in Abyss (S2)',
+    'Re:Zero kara Hajimeru Isekai Seikatsu 2',
+    'One Piece',
+    'Bleach: Sennen Kessen-hen Special',
+    'Spy x Family OVA',
+    'Lycoris Recoil',
+    'Classroom of the Elite Season 3',
+    'Fate/kaleid liner Prisma Illya',
+]
+
+
+def make_homepage(count):
+    """Synthetic homepage with count airing boxes, like the real layout"""
+    boxes = []
+    for i in range(count):
+        title = sample_titles[i % len(sample_titles)]
+        if i >= len(sample_titles):
+            title = '{} {}'.format(title, i)
+        boxes.append(
+            '<div class="airing_box">'
+            '<div class="airing_box_mid_link">'
+            '<a class="full_click" href="//www.animerush.tv/anime/show-{i}/">{title}</a>'
+            '<div class="airing_box_mid"><h3><a href="//www.animerush.tv/anime/show-{i}/">{title}</a></h3>'
+            '<img src="//www.animerush.tv/img/{i}.jpg"/><p>Episode {ep}</p></div>'
+            '</div></div>'.format(i=i, title=title, ep=i % 24 + 1))
+    filler = '<div class="news"><p>' + 'lorem ipsum ' * 200 + '</p></div>'
+    return ('<html><head><title>AnimeRush</title></head><body>'
+            + filler * 20 + ''.join(boxes) + filler * 20 + '</body></html>')
+
+
+def legacy_build_list(soup):
+    """The original build_list, for comparison"""
+    season_bits = [
+        '0th', '1st', '2nd', '3rd', '4th', '5th', '6th', '7th', '8th', '9th',
+    ]
+    ongoing_list = []
+    for anime in soup.find_all('div', attrs={'class': 'airing_box_mid_link'}):
+        anime_descendants = anime.descendants
+        for d in anime_descendants:
+            if d.name == 'a' and d.get('class', '') == ['full_click']:
+                a_dict = dict()
+                season = 1
+                fix_str = d.text.encode("ascii", 'ignore')
+                name = fix_str.decode()
+                name = name.replace('/', '+')
+                for (i, sea) in enumerate(season_bits):
+                    if ' Season' in name:
+                        season = i
+                        name = re.sub(re.compile(' *' + sea + ' Season'), '', name)
+                for i in range(1, 9):
+                    ss = 'Season ' + str(i)
+                    if 'ss' in name:
+                        season = i
+                        name = re.sub(re.compile(' *' + ss), '', name)
+                    if name.endswith(' S' + str(i)):
+                        season = i
+                        name = re.sub(re.compile(' \\(*S' + str(i) + '\\)*$'), '', name)
+                    if name.endswith(' ' + str(i)):
+                        season = i
+                        name = re.sub(re.compile(' ' + str(i) + '$'), '', name)
+                if 'OVA' in name:
+                    season = 0
+                    name = re.sub(re.compile(' OVA'), '', name)
+                if 'Special' in name:
+                    season = 0
+                    name = re.sub(re.compile(' Specials*'), '', name)
+                a_dict['full_name'] = d.text
+                if not d['href'].startswith('http'):
+                    a_dict['url'] = 'https:' + d['href']
+                else:
+                    a_dict['url'] = d['href']
+                a_dict['name'] = name
+                a_dict['season'] = season
+                ongoing_list.append(a_dict)
+    return ongoing_list
+
+
+def bench_ongoing(args):
+    """Homepage parse, legacy full html.parser walk vs strained parse"""
+    pages = []
+    # the saved pages under fixtures/ unless given others
+    fixtures = args.fixtures or sorted(glob.glob(os.path.join(here, 'fixtures', '*.html')))
+    for fixture in fixtures:
+        with open(fixture, 'r', encoding='utf-8') as stream:
+            pages.append((os.path.basename(fixture), stream.read()))
+    for count in args.sizes:
+        pages.append(('synthetic {}'.format(count), make_homepage(count)))
+
+    print('parser: ' + anime_list.html_parser)
+    print('{:<30} {:>8} {:>12} {:>12} {:>8}'.format('page', 'shows', 'legacy ms',
+                                                   'new ms', 'same'))
+    for (label, html) in pages:
+        def run_legacy():
+            return legacy_build_list(BeautifulSoup(html, 'html.parser'))
+
+        def run_new():
+            aro = anime_list.AnimeRushOngoing()
+            return aro.build_list(aro.parse_page(html))
+
+        def deduped(ongoing):
+            # build_list lists a show once however often the page repeats it
+            first = dict()
+            for anime in ongoing:
+                first.setdefault(anime['full_name'], anime)
+            return list(first.values())
+
+        same = deduped(run_legacy()) == run_new()
+        t_old = timeit.timeit(run_legacy, number=args.repeat) / args.repeat
+        t_new = timeit.timeit(run_new, number=args.repeat) / args.repeat
+        print('{:<30} {:>8} {:>12.2f} {:>12.2f} {:>8}'.format(
+            label[-30:], len(run_new()), t_old * 1e3, t_new * 1e3, str(same)))
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time(repeat):
+    """Median wall time to import anime_list, and its heaviest imports"""
+    walls = []
+    heavy = dict()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import anime_list'],
+                              cwd=here, capture_output=True, text=True, check=True)
+        walls.append(time.perf_counter() - start)
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = line.split('|')
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            name = parts[2].rstrip()
+            # direct imports of anime_list only, deeper ones are indented further
+            if len(name) - len(name.lstrip()) != 3:
+                continue
+            name = name.strip()
+            heavy[name] = max(heavy.get(name, 0), int(parts[1]))
+    return statistics.median(walls), heavy
+
+
+class FirstRequestHandler(BaseHTTPRequestHandler):
+    """Serves an empty feed and homepage, notes when the first request lands"""
+    first = None
+
+    def do_GET(self):
+        if FirstRequestHandler.first is None:
+            FirstRequestHandler.first = time.perf_counter()
+        if self.path.startswith('/rss.xml'):
+            body = ('<?xml version="1.0"?><rss version="2.0"><channel>'
+                    '<title>AnimeRush RSS</title></channel></rss>')
+        else:
+            body = '<html><body></body></html>'
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+
+def first_request_time(repeat):
+    """Median time from process start to its first request, and to exit"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FirstRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    firsts = []
+    totals = []
+    with tempfile.TemporaryDirectory() as tmp:
+        conf_f = tmp + '/ar_conf.yml'
+        for _ in range(repeat):
+            with open(conf_f, 'w') as stream:
+                stream.write('base_directory: {}\n'.format(tmp))
+                stream.write('quality: 1080p\nfallback_qualities: [1080p, 720p]\n')
+                stream.write('rss_url: {}rss.xml\nsite_url: {}\n'.format(base, base))
+                stream.write('homepage_ttl: 0\nmonitored: []\n')
+            # a cold run every time, no validators or cached pages
+            for name in ('feed_state.json', 'homepage.html'):
+                if os.path.exists(tmp + '/.animerush_rss/' + name):
+                    os.remove(tmp + '/.animerush_rss/' + name)
+            FirstRequestHandler.first = None
+            start = time.perf_counter()
+            subprocess.run([sys.executable, 'anime_list.py', '-c', conf_f],
+                           cwd=here, capture_output=True, check=True)
+            totals.append(time.perf_counter() - start)
+            firsts.append(FirstRequestHandler.first - start)
+    server.shutdown()
+    return statistics.median(firsts), statistics.median(totals)
+
+
+class PayloadHandler(BaseHTTPRequestHandler):
+    """Serves a fake video with Range support and a per connection rate cap"""
+    payload = b''
+    conn_rate = 0
+
+    def do_GET(self):
+        size = len(self.payload)
+        start, end = 0, size - 1
+        rng = self.headers.get('Range')
+        if rng:
+            m = re.match(r'bytes=(\d+)-(\d*)', rng)
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        step = 1 << 16
+        for offset in range(start, end + 1, step):
+            chunk = self.payload[offset:min(offset + step, end + 1)]
+            self.wfile.write(chunk)
+            if self.conn_rate:
+                time.sleep(len(chunk) / self.conn_rate)
+
+    def log_message(self, format, *args):
+        return
+
+
+def bench_download(args):
+    """Download engines against a local server serving a large file"""
+    PayloadHandler.payload = os.urandom(args.size_mb << 20)
+    PayloadHandler.conn_rate = args.conn_rate_mb * (1 << 20)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PayloadHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/episode.mp4'.format(server.server_address[1])
+
+    print('{:<16} {:>10} {:>10} {:>8}'.format('engine', 'seconds', 'MB/s', 'intact'))
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = [('resume', lambda path: anime_list.download_stream(url, path))]
+        for segments in args.segments:
+            runs.append(('segmented x{}'.format(segments),
+                         lambda path, n=segments: anime_list.download_segmented(
+                             url, path, segments=n)))
+        for (label, run) in runs:
+            path = tmp + '/' + label.replace(' ', '_') + '.mp4'
+            start = time.perf_counter()
+            run(path)
+            took = time.perf_counter() - start
+            with open(path, 'rb') as stream:
+                intact = stream.read() == PayloadHandler.payload
+            print('{:<16} {:>10.2f} {:>10.1f} {:>8}'.format(
+                label, took, args.size_mb / took, str(intact)))
+    server.shutdown()
+
+
+class StandInSite:
+    """Synthetic AnimeRush: feed, homepage, series, episode and video pages"""
+
+    def __init__(self, shows, entries, episodes, video_kb, latency_ms):
+        self.shows = shows
+        self.entries = entries
+        self.episodes = episodes
+        self.payload = os.urandom(video_kb << 10)
+        self.latency = latency_ms / 1000.0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.base = None
+        self.server = None
+        # everything but the feed and homepage answers 503
+        self.down = False
+
+    def title(self, show):
+        return 'Stand In Show {}'.format(show)
+
+    def qualities(self, show):
+        # every third show only has 720p, so quality negotiation has work to do
+        if show % 3 == 0:
+            return ['720p']
+        return ['1080p', '720p']
+
+    def rss(self):
+        items = []
+        for j in range(self.entries):
+            show = j % self.shows
+            ep = self.episodes - j // self.shows
+            if ep < 1:
+                break
+            link = '{}episode/{}/{}'.format(self.base, show, ep)
+            items.append('<item><title>{} episode {}</title><link>{}</link>'
+                         '<guid>{}</guid><category>{}</category></item>'.format(
+                             self.title(show), ep, link, link, self.title(show)))
+        return ('<?xml version="1.0"?><rss version="2.0"><channel>'
+                '<title>AnimeRush RSS</title>' + ''.join(items) + '</channel></rss>')
+
+    def homepage(self):
+        boxes = []
+        for show in range(self.shows):
+            boxes.append('<div class="airing_box"><div class="airing_box_mid_link">'
+                         '<a class="full_click" href="{}series/{}">{}</a>'
+                         '</div></div>'.format(self.base, show, self.title(show)))
+        return '<html><body>' + ''.join(boxes) + '</body></html>'
+
+    def series(self, show):
+        links = ['<a href="{}episode/{}/{}">Episode {}</a>'.format(self.base, show, ep, ep)
+                 for ep in range(self.episodes, 0, -1)]
+        return ('<html><body><div class="amin_week_box_up1"><h1>{}</h1></div>'
+                '<div class="episode_list">{}</div></body></html>'.format(
+                    self.title(show), ''.join(links)))
+
+    def episode(self, show, ep):
+        frames = ['<iframe data-quality="{q}" src="{base}video/{show}/{ep}/{q}.mp4"></iframe>'.format(
+            q=q, base=self.base, show=show, ep=ep) for q in self.qualities(show)]
+        return '<html><body>' + ''.join(frames) + '</body></html>'
+
+    def start(self):
+        site = self
+
+        class Handler(PayloadHandler):
+            payload = site.payload
+
+            def do_GET(self):
+                with site.lock:
+                    site.requests += 1
+                if site.latency:
+                    time.sleep(site.latency)
+                parts = self.path.strip('/').split('/')
+                if site.down and parts[0] in ('video', 'series', 'episode'):
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if parts[0] == 'video':
+                    return PayloadHandler.do_GET(self)
+                if parts[0] == 'rss.xml':
+                    body = site.rss()
+                elif parts[0] == 'series':
+                    body = site.series(int(parts[1]))
+                elif parts[0] == 'episode':
+                    body = site.episode(int(parts[1]), int(parts[2]))
+                else:
+                    body = site.homepage()
+                data = body.encode()
+                etag = '"{}"'.format(hash(data))
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class StandInSeries:
+    """Plays the part of anime_downloader's AnimeRush against the stand-in site"""
+    QUALITIES = ['360p', '480p', '720p', '1080p']
+
+    def __init__(self, url, quality='720p', fallback_qualities=None):
+        self.url = url
+        self.quality = quality
+        self._fallback_qualities = fallback_qualities or ['720p', '480p', '360p']
+        response = anime_list.get_session().get(url)
+        # helpers.get raises for status the same way
+        response.raise_for_status()
+        html = response.text
+        links = re.findall(r'<a href="([^"]+)">Episode', html)
+        self._episode_urls = [(no + 1, link) for (no, link) in enumerate(links[::-1])]
+        self._len = len(self._episode_urls)
+        self.title = url.rstrip('/').rsplit('/', 1)[-1]
+        # the real class fails the same way on an empty list
+        self._episode_urls[0]
+
+
+class StandInSource:
+    headers = {}
+    referer = ''
+
+    def __init__(self, stream_url):
+        self.stream_url = stream_url
+
+
+class StandInEpisode:
+    """Plays the part of AnimeRushEpisode, walking the qualities like it does"""
+    # external_download reads these
+    headers = {}
+
+    def __init__(self, url, parent=None, ep_no=None):
+        from anime_downloader.sites.exceptions import NotFoundError
+        self.url = url
+        self.ep_no = ep_no
+        self._parent = parent
+        response = anime_list.get_session().get(url)
+        response.raise_for_status()
+        html = response.text
+        offered = dict(re.findall(r'data-quality="([^"]+)" src="([^"]+)"', html))
+        order = [parent.quality] + [q for q in parent._fallback_qualities if q != parent.quality]
+        for quality in order:
+            if quality in offered:
+                self.quality = quality
+                self._source = StandInSource(offered[quality])
+                return
+        raise NotFoundError('No episode sources found.')
+
+    def source(self):
+        return self._source
+
+    def download(self, path=None):
+        anime_list.download_stream(self._source.stream_url, path)
+
+
+def bench_e2e(args):
+    """Drive the real run paths against a local stand-in for the site"""
+    site = StandInSite(args.shows, args.entries, args.episodes, args.video_kb, args.latency_ms)
+    site.start()
+    anime_list.animerush_classes = lambda: (StandInSeries, StandInEpisode)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = {
+            'base_directory': tmp + '/library',
+            'quality': '1080p',
+            'fallback_qualities': ['1080p', '720p', '480p'],
+            'rss_url': site.base + 'rss.xml',
+            'site_url': site.base,
+            'homepage_ttl': 0,
+            'download_engine': args.engine,
+            'download_workers': args.workers,
+            'per_host_downloads': args.workers,
+            'monitored': [],
+        }
+        for show in range(args.shows):
+            entry = {'full_name': site.title(show), 'monitored': show % args.monitored_every == 0}
+            if entry['monitored']:
+                entry.update({'name': site.title(show), 'season': 1, 'season_offset': 0,
+                              'url': '{}series/{}'.format(site.base, show)})
+            entry['full_name'] = site.title(show)
+            config['monitored'].append(entry)
+        # the homepage lists a few shows nobody has seen yet
+        config['monitored'] = config['monitored'][:max(0, args.shows - args.new_shows)]
+
+        registry = anime_list.MonitoredRegistry(config['monitored'])
+        index = anime_list.EpisodeIndex(anime_list.state_path(config, 'episode_index.json'))
+        state = anime_list.StateStore(anime_list.state_path(config, 'state.db'))
+        anime_list.series_cache.qualities = anime_list.QualityCache(state)
+
+        def catch_up():
+            # bounded, a full backfill of every monitored show is a soak test
+            limited = anime_list.MonitoredRegistry(
+                [a for a in config['monitored'] if a['monitored']][:args.catch_up_shows])
+            anime_list.catch_up_all_anime(config, limited, index, state, False)
+
+        def default_run():
+            # what main() does without -i/-s/-n: the feed, then the homepage
+            if args.pipeline:
+                return anime_list.run_pipeline(config, registry, index, state)
+            anime_list.parse_rss(config, registry, index, state)
+            return anime_list.new_anime_check(config, registry)
+
+        limited = anime_list.MonitoredRegistry(
+            [a for a in config['monitored'] if a['monitored']][:args.catch_up_shows * 2])
+        plan_file = tmp + '/plan.json'
+
+        def plan():
+            anime_list.write_plan(anime_list.build_plan(config, limited, index), plan_file)
+
+        steps = [
+            ('rss cold', default_run),
+            ('rss 304', default_run),
+            ('new_anime_check', lambda: anime_list.new_anime_check(config, registry)),
+            ('catch_up_all', catch_up),
+            ('plan', plan),
+            ('run plan', lambda: anime_list.execute_plan(config, limited, index, state,
+                                                         plan_file)),
+        ]
+        results = []
+        for (label, step) in steps:
+            anime_list.report.reset(label)
+            before = site.requests
+            start = time.perf_counter()
+            step()
+            took = time.perf_counter() - start
+            results.append((label, took, site.requests - before, anime_list.report.to_dict()))
+        state.close()
+
+    site.stop()
+
+    print()
+    print('{} shows, {} feed entries, {} episodes each, {} ms latency, {} KB videos'.format(
+        args.shows, args.entries, args.episodes, args.latency_ms, args.video_kb))
+    print('{:<18} {:>9} {:>9} {:>11} {:>11}'.format('step', 'seconds', 'requests',
+                                                   'downloads', 'MB/s'))
+    for (label, took, requests, data) in results:
+        downloads = data['downloads']
+        print('{:<18} {:>9.2f} {:>9} {:>11} {:>11.1f}'.format(
+            label, took, requests, downloads['count'], downloads['bytes_per_second'] / 1e6))
+    print()
+    print('{:<18} {:<16} {:>7} {:>10} {:>10}'.format('step', 'phase', 'calls', 'mean ms', 'max ms'))
+    for (label, took, requests, data) in results:
+        for (name, phase) in sorted(data['phases'].items()):
+            print('{:<18} {:<16} {:>7} {:>10.2f} {:>10.2f}'.format(
+                label, name, phase['calls'], phase['seconds'] / phase['calls'] * 1e3,
+                phase['max_seconds'] * 1e3))
+
+
+def bench_outage(args):
+    """Runs against a site whose series and video pages answer 503"""
+    site = StandInSite(args.shows, args.entries, args.episodes, 64, args.latency_ms)
+    site.start()
+    site.down = True
+    anime_list.animerush_classes = lambda: (StandInSeries, StandInEpisode)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = {
+            'base_directory': tmp + '/library',
+            'quality': '1080p',
+            'fallback_qualities': ['1080p', '720p'],
+            'rss_url': site.base + 'rss.xml',
+            'site_url': site.base,
+            'retry_backoff': args.backoff,
+            'monitored': [{'full_name': site.title(show), 'name': site.title(show),
+                           'monitored': True, 'season': 1, 'season_offset': 0,
+                           'url': '{}series/{}'.format(site.base, show)}
+                          for show in range(args.shows)],
+        }
+        anime_list._session = None
+        anime_list.install_session(config)
+        registry = anime_list.MonitoredRegistry(config['monitored'])
+        index = anime_list.EpisodeIndex()
+        state = anime_list.StateStore(anime_list.state_path(config, 'state.db'))
+
+        print('{:<10} {:>9} {:>9}  {}'.format('run', 'seconds', 'requests', 'counters'))
+        for run in range(args.runs):
+            anime_list.report.reset('outage')
+            anime_list.series_cache.clear()
+            # a fresh process each cron tick, state carries over like it would
+            # so the host_down entries have to get the feed past its 304
+            anime_list._session = None
+            anime_list.install_session(config)
+            before = site.requests
+            start = time.perf_counter()
+            try:
+                anime_list.parse_rss(config, registry, index, state)
+            except requests.RequestException as e:
+                # the feed shares the host, main() reports this and moves on
+                print('feed: ' + str(e))
+            took = time.perf_counter() - start
+            counters = anime_list.report.to_dict()['counters']
+            print('{:<10} {:>9.2f} {:>9}  {}'.format(
+                'run {}'.format(run + 1), took, site.requests - before,
+                ', '.join('{}={}'.format(k, v) for (k, v) in sorted(counters.items()))))
+        state.close()
+    site.stop()
+
+
+def bench_startup(args):
+    """CLI startup cost, checked against a budget"""
+    wall, heavy = import_time(args.repeat)
+    print('import anime_list: {:.1f} ms (median of {})'.format(wall * 1e3, args.repeat))
+    print('heaviest imports made by anime_list:')
+    for name in sorted(heavy, key=heavy.get, reverse=True)[:args.top]:
+        print('  {:<30} {:>8.1f} ms'.format(name, heavy[name] / 1e3))
+
+    first, total = first_request_time(args.repeat)
+    print('time to first request: {:.1f} ms'.format(first * 1e3))
+    print('headless run, nothing new: {:.1f} ms'.format(total * 1e3))
+
+    if args.budget_ms is not None and first * 1e3 > args.budget_ms:
+        print('over budget of {} ms'.format(args.budget_ms))
+        sys.exit(1)
+
+
+def bench_config(args):
+    """Config load and save cost from 100 to 50k monitored entries"""
+    import yaml
+    print('libyaml: ' + str(hasattr(yaml, 'CSafeLoader')))
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'shows', 'pure load', 'C load', 'cached', 'pure dump', 'save'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            conf_f = '{}/conf_{}.yml'.format(tmp, size)
+            config = {'base_directory': tmp, 'quality': '1080p',
+                      'fallback_qualities': ['1080p', '720p', '480p', '360p'],
+                      'external_downloader': '{aria2}',
+                      'monitored': make_monitored(size)}
+            with open(conf_f, 'w') as stream:
+                yaml.dump(config, stream)
+
+            def pure_load():
+                with open(conf_f, 'r') as stream:
+                    return yaml.safe_load(stream)
+
+            def c_load():
+                # drop the cache so this is a real parse
+                if os.path.exists(anime_list.config_cache_file(conf_f)):
+                    os.remove(anime_list.config_cache_file(conf_f))
+                return anime_list.parse_config(conf_f)
+
+            def pure_dump():
+                with open(conf_f + '.pure', 'w') as stream:
+                    yaml.dump(config, stream)
+
+            repeat = max(1, args.repeat * 100 // max(size, 100))
+            t_pure = timeit.timeit(pure_load, number=repeat) / repeat
+            t_c = timeit.timeit(c_load, number=repeat) / repeat
+            anime_list.parse_config(conf_f)
+            t_cached = timeit.timeit(lambda: anime_list.parse_config(conf_f),
+                                     number=repeat) / repeat
+            t_dump = timeit.timeit(pure_dump, number=repeat) / repeat
+            t_save = timeit.timeit(lambda: anime_list.save_config(config, conf_f),
+                                   number=repeat) / repeat
+            assert anime_list.parse_config(conf_f) == pure_load()
+            print('{:>8} {:>9.1f}ms {:>9.1f}ms {:>9.1f}ms {:>9.1f}ms {:>9.1f}ms'.format(
+                size, t_pure * 1e3, t_c * 1e3, t_cached * 1e3, t_dump * 1e3, t_save * 1e3))
+
+
+def make_feed(count):
+    """An AnimeRush style rss feed with count items, newest first"""
+    items = []
+    for i in range(count, 0, -1):
+        items.append('<item><title>Show Number {} Season 2 episode {}</title>'
+                     '<link>https://www.animerush.tv/anime/show-{}-episode-{}/</link>'
+                     '<guid>show-{}-episode-{}</guid><category>Show Number {} Season 2</category>'
+                     '</item>'.format(i, i, i, i, i, i, i))
+    return ('<?xml version="1.0"?><rss version="2.0"><channel>'
+            '<title>AnimeRush RSS</title>' + ''.join(items) + '</channel></rss>').encode()
+
+
+def bench_feed(args):
+    """Feed read cost, whole feed against only the entries newer than last run"""
+    import tracemalloc
+
+    class FeedHandler(BaseHTTPRequestHandler):
+        body = b''
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.body)))
+            self.end_headers()
+            try:
+                self.wfile.write(self.body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the reader stopped early
+                pass
+
+        def log_message(self, format, *args):
+            return
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/rss.xml'.format(server.server_address[1])
+
+    def previous_run(state_file, state, count):
+        # a real run over the older feed, so last_guid is whatever mark_read left
+        FeedHandler.body = make_feed(count)
+        rss = anime_list.AnimeRushRSS(state_file, url=url)
+        rss.load_rss()
+        for e in rss.get_entries():
+            # mostly shows nobody monitors, as on the real feed
+            state.record(rss.guid(e), rss.show_name(e), rss.ep_num(e), 'not_monitored')
+        rss.mark_read(state)
+
+    def read(state_file):
+        rss = anime_list.AnimeRushRSS(state_file, url=url)
+        rss.load_rss()
+        return sum(1 for _ in rss.get_entries())
+
+    print('{:>8} {:>6} {:>10} {:>10} {:>12}'.format('items', 'new', 'read', 'ms', 'peak KB'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            for new in args.new:
+                if new > size:
+                    continue
+                state_file = '{}/feed_state_{}_{}.json'.format(tmp, size, new)
+                state = anime_list.StateStore('{}/state_{}_{}.db'.format(tmp, size, new))
+                # new == size reads to the end, like a first run
+                if new < size:
+                    previous_run(state_file, state, size - new)
+                state.close()
+                FeedHandler.body = make_feed(size)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    count = read(state_file)
+                took = (time.perf_counter() - start) / args.repeat
+                tracemalloc.start()
+                read(state_file)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('{:>8} {:>6} {:>10} {:>10.2f} {:>12.1f}'.format(
+                    size, new, count, took * 1e3, peak / 1024))
+    server.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p_reg = sub.add_parser('registry', help='Monitored list lookups')
+    p_reg.add_argument('--sizes', type=int, nargs='+',
+                       default=[100, 1000, 5000, 20000])
+    p_reg.add_argument('--repeat', type=int, default=20)
+    p_reg.set_defaults(func=bench_registry)
+
+    p_ong = sub.add_parser('ongoing', help='Homepage ongoing list parse')
+    p_ong.add_argument('fixtures', nargs='*',
+                       help='Saved homepage html files, default fixtures/*.html')
+    p_ong.add_argument('--sizes', type=int, nargs='*', default=[60, 500])
+    p_ong.add_argument('--repeat', type=int, default=5)
+    p_ong.set_defaults(func=bench_ongoing)
+
+    p_start = sub.add_parser('startup', help='Import time and time to first request')
+    p_start.add_argument('--repeat', type=int, default=5)
+    p_start.add_argument('--top', type=int, default=10)
+    p_start.add_argument('--budget-ms', type=float, default=None,
+                         help='Fail if time to first request is over this')
+    p_start.set_defaults(func=bench_startup)
+
+    p_dl = sub.add_parser('download', help='Single stream vs segmented downloads')
+    p_dl.add_argument('--size-mb', type=int, default=64)
+    p_dl.add_argument('--conn-rate-mb', type=float, default=8,
+                      help='Per connection server rate in MB/s, 0 for none')
+    p_dl.add_argument('--segments', type=int, nargs='+', default=[2, 4, 8])
+    p_dl.set_defaults(func=bench_download)
+
+    p_e2e = sub.add_parser('e2e', help='Full runs against a local stand-in site')
+    p_e2e.add_argument('--shows', type=int, default=10000)
+    p_e2e.add_argument('--entries', type=int, default=500)
+    p_e2e.add_argument('--episodes', type=int, default=12)
+    p_e2e.add_argument('--monitored-every', type=int, default=20)
+    p_e2e.add_argument('--new-shows', type=int, default=5)
+    p_e2e.add_argument('--catch-up-shows', type=int, default=10)
+    p_e2e.add_argument('--latency-ms', type=float, default=20)
+    p_e2e.add_argument('--video-kb', type=int, default=256)
+    p_e2e.add_argument('--workers', type=int, default=4)
+    p_e2e.add_argument('--pipeline', action='store_true',
+                       help='Run the default path through the asyncio pipeline')
+    p_e2e.add_argument('--engine', default='resume',
+                       choices=['resume', 'segmented', 'plain'])
+    p_e2e.set_defaults(func=bench_e2e)
+
+    p_out = sub.add_parser('outage', help='Runs while the site is down')
+    p_out.add_argument('--shows', type=int, default=50)
+    p_out.add_argument('--entries', type=int, default=50)
+    p_out.add_argument('--episodes', type=int, default=3)
+    p_out.add_argument('--latency-ms', type=float, default=20)
+    p_out.add_argument('--backoff', type=float, default=0.5)
+    p_out.add_argument('--runs', type=int, default=3)
+    p_out.set_defaults(func=bench_outage)
+
+    p_conf = sub.add_parser('config', help='Config file load and save')
+    p_conf.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 50000])
+    p_conf.add_argument('--repeat', type=int, default=5)
+    p_conf.set_defaults(func=bench_config)
+
+    p_feed = sub.add_parser('feed', help='Streaming rss read with early exit')
+    p_feed.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    p_feed.add_argument('--new', type=int, nargs='+', default=[1, 10, 100, 10000])
+    p_feed.add_argument('--repeat', type=int, default=5)
+    p_feed.set_defaults(func=bench_feed)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()